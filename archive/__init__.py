@@ -1,6 +1,30 @@
 import os
 import tarfile
 import zipfile
+import threading
+import subprocess
+import shutil
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# external multi-threaded decompressors, tried in order; single threaded
+# gzip and bzip2 are not faster than the python modules
+decompressors = {
+    '.gz': [['pigz', '-dc']],
+    '.tgz': [['pigz', '-dc']],
+    '.bz2': [['pbzip2', '-dc'], ['lbzip2', '-dc']],
+    '.tz2': [['pbzip2', '-dc'], ['lbzip2', '-dc']],
+    '.xz': [['xz', '-T0', '-dc']],
+    '.txz': [['xz', '-T0', '-dc']],
+    '.zst': [['zstd', '-T0', '-dc']],
+}
+
+# set to False to always decompress in python
+use_external_decompressors = True
 
 
 class ArchiveException(Exception):
@@ -13,6 +37,9 @@ class UnsafeArchive(ArchiveException):
     """Error raised when passed file contains absolute paths which could be
     extracted outside of the target directory."""
 
+class DecompressionError(ArchiveException):
+    """Error raised when an external decompressor failed."""
+
 
 def extract(path, to_path='', safe=False, filename=None):
     """
@@ -22,6 +49,117 @@ def extract(path, to_path='', safe=False, filename=None):
     Archive(path, filename).extract(to_path, safe)
 
 
+def is_tar(filename):
+    """
+    Check if the file name points to a tar archive, which can be
+    unpacked while it is being read.
+    """
+    try:
+        return Archive._archive_cls(None, filename) is TarArchive
+    except UnrecognizedArchiveFormat:
+        return False
+
+
+def extract_stream(fileobj, to_path='', filename=None):
+    """
+    Unpack the (compressed) tar archive read from fileobj to the
+    directory specified by to_path. The file object is read once from
+    the beginning to the end, it does not have to support seeking.
+    """
+    command = get_decompressor(filename) if filename else None
+    if command is None:
+        _check_python_support(filename)
+        stream = tarfile.open(fileobj=fileobj, mode='r|*')
+        try:
+            stream.extractall(to_path)
+        finally:
+            stream.close()
+        return
+
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    # feed the decompressor from another thread, the tar stream is
+    # read from its output at the same time
+    feeder = threading.Thread(target=_feed, args=(fileobj, proc.stdin))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        _extract_pipe(proc, to_path)
+    finally:
+        feeder.join()
+
+
+def get_decompressor(filename):
+    """
+    Return the command decompressing the given archive from stdin to
+    stdout, or None if it should be decompressed in python.
+    """
+    if not use_external_decompressors:
+        return None
+    ext = os.path.splitext(filename.lower())[1]
+    for command in decompressors.get(ext, []):
+        if _find_executable(command[0]) is not None:
+            return command
+    return None
+
+
+_executables = dict()
+
+
+def _find_executable(name):
+    if name not in _executables:
+        _executables[name] = None
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            candidate = os.path.join(path, name)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                _executables[name] = candidate
+                break
+    return _executables[name]
+
+
+def _check_python_support(filename):
+    # tarfile does not handle zstd, and xz only on python 3
+    ext = os.path.splitext(filename.lower())[1] if filename else ''
+    if ext == '.zst' or (ext in ('.xz', '.txz') and
+                         'xz' not in tarfile.TarFile.OPEN_METH):
+        raise UnrecognizedArchiveFormat(
+            "No decompressor found for %s" % filename)
+
+
+def _feed(src, dst):
+    try:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    except (IOError, OSError):
+        # the decompressor exited early, it reports the error
+        pass
+    finally:
+        try:
+            dst.close()
+        except (IOError, OSError):
+            pass
+
+
+def _extract_pipe(proc, to_path):
+    try:
+        stream = tarfile.open(fileobj=proc.stdout, mode='r|')
+        try:
+            stream.extractall(to_path)
+        finally:
+            stream.close()
+        # read the end of the archive, e.g. the padding
+        while proc.stdout.read(1024 * 1024):
+            pass
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise DecompressionError("Decompression failed with exit code %d"
+                                 % proc.returncode)
+
+
 class Archive(object):
     """
     The external API class that encapsulates an archive implementation.
@@ -87,8 +225,20 @@ class BaseArchive(object):
 class TarArchive(BaseArchive):
 
     def __init__(self, file):
-        self._archive = tarfile.open(file) if isinstance(file, basestring) \
-                else tarfile.open(fileobj=file)
+        # the archive is opened lazily, extracting it with an external
+        # decompressor does not need it
+        self._file = file
+        self._tarfile = None
+
+    @property
+    def _archive(self):
+        if self._tarfile is None:
+            if isinstance(self._file, basestring):
+                _check_python_support(self._file)
+                self._tarfile = tarfile.open(self._file)
+            else:
+                self._tarfile = tarfile.open(fileobj=self._file)
+        return self._tarfile
 
     def printdir(self, *args, **kwargs):
         self._archive.list(*args, **kwargs)
@@ -97,7 +247,16 @@ class TarArchive(BaseArchive):
         return self._archive.getnames(*args, **kwargs)
 
     def extract(self, to_path=''):
-        self._archive.extractall(to_path)
+        command = None
+        if self._tarfile is None and isinstance(self._file, basestring):
+            command = get_decompressor(self._file)
+        if command is None:
+            self._archive.extractall(to_path)
+            return
+
+        proc = subprocess.Popen(command + [self._file],
+                                stdout=subprocess.PIPE)
+        _extract_pipe(proc, to_path)
 
 
 class ZipArchive(BaseArchive):
@@ -121,6 +280,9 @@ extension_map = {
     '.tar': TarArchive,
     '.tar.bz2': TarArchive,
     '.tar.gz': TarArchive,
+    '.tar.xz': TarArchive,
+    '.tar.zst': TarArchive,
+    '.txz': TarArchive,
     '.tgz': TarArchive,
     '.tz2': TarArchive,
     '.zip': ZipArchive,
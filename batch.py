@@ -0,0 +1,434 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file batch.py
+# \brief Enclustra Build Environment batch build class
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import fcntl
+import multiprocessing
+
+import cache
+from utils import Utils
+from target import Target
+
+
+class Batch:
+    """
+    Builds the default configuration of many devices in one run.
+
+    The sources are fetched once for every repository and branch, and
+    the toolchains are acquired once. Every device is then built in a
+    process of its own, with its output in out_<device>/build.log.
+    Devices needing a repository at different branches are built in
+    separate waves, with the repository checked out again in between.
+    """
+
+    def __init__(self, settings, utils, download_cache, registered_toolchains):
+        # plain values passed on to the device jobs, see build_device
+        self.settings = settings
+        self.utils = utils
+        self.download_cache = download_cache
+        self.registered_toolchains = registered_toolchains
+        # repository -> (patch series, target object, target) of the
+        # last wave patching it
+        self.patched = dict()
+
+    @staticmethod
+    def read_devices_file(path):
+        # one device per line, empty lines and comments are skipped
+        devices = []
+        with open(path, "r") as devices_file:
+            for line in devices_file:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    devices.append(line.strip("/"))
+        return devices
+
+    def remove_duplicates(self, devices):
+        # a device listed twice would be built twice at the same time
+        # into the same output directory, the order is kept
+        unique = []
+        names = set()
+        for device in devices:
+            name = get_device_name(os.path.normpath(device))
+            if name in names:
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Device listed more than once,",
+                                         "building it once:", device)
+                continue
+            names.add(name)
+            unique.append(device)
+        return unique
+
+    def load_targets(self, devices):
+        root_path = self.settings["root_path"]
+        targets = []
+        for device in devices:
+            dev_path = root_path + "/targets/" + device
+            try:
+                ini_files = self.utils.get_ini_files(root_path, device)
+            except ValueError as exc:
+                self.utils.print_message(self.utils.logtype.ERROR, str(exc))
+                targets.append((device, None))
+                continue
+            if not os.path.isdir(dev_path) or \
+                    [n for n in os.listdir(dev_path)
+                     if os.path.isdir(os.path.join(dev_path, n))]:
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "device argument not complete: " +
+                                         device)
+                targets.append((device, None))
+                continue
+            try:
+                t = Target(root_path, self.settings["master_repo_path"],
+                           dev_path, ini_files, get_device_name(device),
+                           self.settings["debug_calls"], self.utils,
+                           self.settings["history_path"],
+                           self.settings["release"], False,
+                           parse_cache=self.settings["parse_cache"])
+            except SystemExit:
+                # the errors in the ini files were reported already
+                targets.append((device, None))
+                continue
+            t.set_active_targets()
+            t.set_binaries(t.get_default_binary())
+            targets.append((device, t))
+        return targets
+
+    def get_patch_series(self, t, target):
+        # the patches of the devices are in their own directories,
+        # their contents count
+        series = []
+        for path in t.get_patch_paths(target):
+            try:
+                series.append(self.utils.get_file_hash(path))
+            except (IOError, OSError):
+                series.append(path)
+        return tuple(series)
+
+    @staticmethod
+    def get_used_targets(t):
+        return [target for target in t.targets
+                if t.targets[target]["fetch"] or t.targets[target]["build"]]
+
+    def get_checkouts(self, t):
+        # repository -> branch and patch series needed by the targets
+        # of a device, a tree patched differently cannot be shared
+        checkouts = dict()
+        for target in self.get_used_targets(t):
+            checkouts[t.targets[target]["repository"]] = \
+                (t.targets[target]["branch"],
+                 self.get_patch_series(t, target))
+        return checkouts
+
+    def get_waves(self, targets):
+        # group the devices which can use the same checkouts
+        waves = []
+        for device, t in targets:
+            if t is None:
+                continue
+            checkouts = self.get_checkouts(t)
+            for wave_checkouts, wave in waves:
+                if all(wave_checkouts.get(repo, checkout) == checkout
+                       for repo, checkout in checkouts.items()):
+                    wave_checkouts.update(checkouts)
+                    wave.append((device, t))
+                    break
+            else:
+                waves.append((checkouts, [(device, t)]))
+        return [wave for checkouts, wave in waves]
+
+    def revert_patches(self, wave, targets):
+        # the sources patched by an earlier wave with another series
+        # are restored before they are fetched and patched again
+        for device, t in wave:
+            for target in self.get_used_targets(t):
+                repository = t.targets[target]["repository"]
+                series = self.get_patch_series(t, target)
+                if repository in self.patched:
+                    previous = [self.patched[repository]]
+                else:
+                    # an earlier run may have left the sources patched
+                    # by any of the devices
+                    previous = dict()
+                    for other_device, other in targets:
+                        if other is None:
+                            continue
+                        for other_target in self.get_used_targets(other):
+                            if other.targets[other_target]["repository"] == \
+                                    repository:
+                                previous[self.get_patch_series(
+                                    other, other_target)] = \
+                                    (other, other_target)
+                    previous = [(s,) + p for s, p in previous.items()]
+                for other_series, other, other_target in previous:
+                    if other_series != series:
+                        other.revert_patches(other_target)
+                self.patched[repository] = (series, t, target)
+
+    def fetch_wave(self, wave, git_use_depth, git_use_remote, fetch_jobs,
+                   reference_mirrors):
+        # every repository is fetched by the first device using it
+        fetched = set()
+        for device, t in wave:
+            fetch = [target for target in t.targets
+                     if t.targets[target]["fetch"] and
+                     t.targets[target]["repository"] not in fetched]
+            if not fetch:
+                continue
+            active = dict((target, t.targets[target]["fetch"])
+                          for target in t.targets)
+            for target in t.targets:
+                t.targets[target]["fetch"] = target in fetch
+            t.do_fetch(git_use_depth, git_use_remote, fetch_jobs,
+                       reference_mirrors)
+            for target in t.targets:
+                t.targets[target]["fetch"] = active[target]
+            fetched.update(t.targets[target]["repository"]
+                           for target in fetch)
+
+    def acquire_toolchains(self, targets):
+        # device -> toolchain paths, None if they could not be acquired
+        toolchains = dict()
+        for device, t in targets:
+            if t is None:
+                continue
+            try:
+                toolchains[device] = self.utils.acquire_toolchains(
+                    t.get_required_toolchains(), self.registered_toolchains,
+                    self.settings["root_path"], self.settings["debug_calls"],
+                    self.download_cache)
+            except Exception as exc:
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "Failed to acquire toolchain for",
+                                         device + ":", str(exc))
+                toolchains[device] = None
+        return toolchains
+
+    def get_binary_downloads(self, targets):
+        downloads = dict()
+        for device, t in targets:
+            if t is None or t.fetch_only_run():
+                continue
+            for binary in t.binaries:
+                if t.is_binary_needed(binary):
+                    downloads[t.binaries[binary]["uri"]] = \
+                        (t.binaries[binary]["redownload"],
+                         t.binaries[binary]["sha256"])
+        return downloads
+
+    def run(self, devices, git_use_depth, git_use_remote, fetch_jobs,
+            reference_mirrors, batch_jobs):
+        """Build all the devices and return the number of failed ones"""
+        start = time.time()
+        devices = self.remove_duplicates(devices)
+        targets = self.load_targets(devices)
+        results = dict((device, ("FAILED", 0.0, None))
+                       for device, t in targets if t is None)
+
+        # the downloads overlap with the fetches, every file
+        # is downloaded once for all the devices
+        for device, t in targets:
+            if t is not None:
+                self.utils.prefetch_toolchains(t.get_required_toolchains(),
+                                               self.registered_toolchains,
+                                               self.settings["root_path"],
+                                               self.download_cache)
+        downloads = self.get_binary_downloads(targets)
+        for url, (force, sha256) in sorted(downloads.items()):
+            self.download_cache.prefetch(url, force=force, sha256=sha256)
+
+        waves = self.get_waves(targets)
+        for number, wave in enumerate(waves):
+            self.utils.print_message(self.utils.logtype.INFO,
+                                     "Batch wave", number + 1, "of",
+                                     str(len(waves)) + ":",
+                                     ", ".join(d for d, t in wave))
+            with self.utils.timing.span("fetch"):
+                self.revert_patches(wave, targets)
+                self.fetch_wave(wave, git_use_depth, git_use_remote,
+                                fetch_jobs, reference_mirrors)
+            if number == 0:
+                with self.utils.timing.span("toolchains"):
+                    toolchains = self.acquire_toolchains(targets)
+                with self.utils.timing.span("binaries"):
+                    for url, (force, sha256) in sorted(downloads.items()):
+                        try:
+                            self.download_cache.fetch(url, force=force,
+                                                      sha256=sha256)
+                        except Exception:
+                            # reported by the devices using it
+                            pass
+
+            jobs = []
+            for device, t in wave:
+                if toolchains.get(device) is None:
+                    results[device] = ("FAILED", 0.0, None)
+                    continue
+                jobs.append((self.settings, device, toolchains[device]))
+            with self.utils.timing.span("devices"):
+                for device, result, elapsed, log_path in \
+                        self.run_jobs(jobs, batch_jobs):
+                    results[device] = (result, elapsed, log_path)
+                    self.utils.print_message(
+                        self.utils.logtype.OK if result == "OK"
+                        else self.utils.logtype.ERROR,
+                        "{:<8} {:>8.1f} s  {}".format(result, elapsed,
+                                                      device))
+
+        return self.print_report(devices, results, time.time() - start)
+
+    def run_jobs(self, jobs, batch_jobs):
+        if not jobs:
+            return
+        # a fresh process for every device, the jobs change
+        # the working directory and the output file descriptors
+        pool = multiprocessing.Pool(min(batch_jobs, len(jobs)),
+                                    maxtasksperchild=1)
+        try:
+            results = pool.imap_unordered(build_device, jobs)
+            while True:
+                try:
+                    result = self.utils.wait_interruptible(
+                        results.next, multiprocessing.TimeoutError)
+                except StopIteration:
+                    break
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def print_report(self, devices, results, elapsed):
+        root_path = self.settings["root_path"]
+        self.utils.print_message(self.utils.logtype.INFO, "-" * 80)
+        self.utils.print_message(self.utils.logtype.INFO,
+                                 "{:<8} {:>10}  {}".format("result",
+                                                           "time [s]",
+                                                           "device"))
+        failed = 0
+        for device in devices:
+            result, device_time, log_path = results.get(device,
+                                                        ("FAILED", 0.0, None))
+            line = "{:<8} {:>10.1f}  {}".format(result, device_time, device)
+            if log_path is not None:
+                line += "  (" + os.path.relpath(log_path, root_path) + ")"
+            if result != "OK":
+                failed += 1
+            self.utils.print_message(self.utils.logtype.INFO, line)
+
+        msg = "{} of {} devices built in {:.1f} s".format(
+            len(devices) - failed, len(devices), elapsed)
+        if failed:
+            self.utils.print_message(self.utils.logtype.ERROR,
+                                     "BATCH FAILED:", msg)
+        else:
+            self.utils.print_message(self.utils.logtype.INFO,
+                                     "BATCH SUCCEEDED:", msg)
+        return failed
+
+
+def get_device_name(device):
+    return device.replace("/", "_").replace(" ", "_")
+
+
+class build_lock:
+    """Context manager locking the build trees of the targets, builds
+    of the same tree in other processes wait for it"""
+    def __init__(self, paths):
+        # sorted, so two processes never wait for each other
+        self.paths = sorted(set(paths))
+        self.lock_files = []
+
+    def __enter__(self):
+        for path in self.paths:
+            # out-of-tree build directories may not exist yet
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        raise
+            lock_file = open(path, "a")
+            self.lock_files.append(lock_file)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, etype, value, traceback):
+        for lock_file in reversed(self.lock_files):
+            lock_file.close()
+        self.lock_files = []
+
+
+def build_device(job):
+    # build a single device, used as a worker of a process pool
+    settings, device, toolchains_paths = job
+    start = time.time()
+    root_path = settings["root_path"]
+    device_name = get_device_name(device)
+    out_dir = root_path + "/out_" + device_name
+    log_path = out_dir + "/build.log"
+
+    utils = Utils()
+    utils.set_colors(False)
+    utils.set_debug_calls(settings["debug_calls"])
+    utils.set_quiet_mode(settings["quiet_mode"])
+    utils.set_break_on_error(settings["break_on_error"])
+    utils.add_tool_template("ebe_release", settings["release"])
+
+    # all the output of the device goes to its log
+    utils.mkdir_p(out_dir + "/overlays")
+    utils.add_tool_template("ebe_overlays", out_dir + "/overlays")
+    sys.stdout.flush()
+    log_file = open(log_path, "w")
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+
+    try:
+        t = Target(root_path, settings["master_repo_path"],
+                   root_path + "/targets/" + device,
+                   utils.get_ini_files(root_path, device), device_name,
+                   settings["debug_calls"], utils, settings["history_path"],
+                   settings["release"], False,
+                   parse_cache=settings["parse_cache"])
+        t.set_active_targets()
+        t.set_binaries(t.get_default_binary())
+        t.out_dir = out_dir
+        download_cache = cache.DownloadCache(settings["cache_dir"],
+                                             settings["cache_size"], utils)
+
+        # the binaries of every device are kept apart, the names
+        # of the binary sets are not unique
+        t.do_get_binaries(root_path + "/binaries/" + device_name,
+                          download_cache)
+        # other devices use the same trees, they must not build
+        # in between this build and copying its results
+        with build_lock(t.get_build_lock_paths()):
+            t.do_build(toolchains_paths, settings["nthreads"],
+                       settings["build_jobs"], settings["force_rebuild"])
+            t.do_copyfiles(int(settings["nthreads"]))
+        t.do_generate_image(out_dir, toolchains_paths)
+    except SystemExit:
+        # break on error, or a fatal error reported already
+        if not utils.get_error_count():
+            utils.print_message(utils.logtype.ERROR, "Building", device,
+                                "aborted")
+    except Exception as exc:
+        utils.print_message(utils.logtype.ERROR, "Building", device,
+                            "failed:", str(exc))
+
+    result = "FAILED" if utils.get_error_count() else "OK"
+    utils.print_message(utils.logtype.INFO, "BUILD " +
+                        ("FAILED" if result == "FAILED" else "SUCCEEDED"))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log_file.close()
+    return device, result, time.time() - start, log_path
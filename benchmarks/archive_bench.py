@@ -0,0 +1,127 @@
+#! /usr/bin/env python2
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file archive_bench.py
+# \brief Compare the archive extraction backends on a synthetic tarball
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import archive
+
+# commands compressing stdin to stdout, the parallel ones first
+compressors = {
+    "gz": [["pigz", "-c"], ["gzip", "-c"]],
+    "bz2": [["pbzip2", "-c"], ["lbzip2", "-c"], ["bzip2", "-c"]],
+    "xz": [["xz", "-T0", "-1", "-c"]],
+    "zst": [["zstd", "-T0", "-q", "-c"]],
+}
+
+
+def generate_tar(path, size_mb, file_mb=4):
+    # half random, half repetitive data, compresses roughly like
+    # a toolchain with binaries and text files
+    text = b"".join(b"line %d of a synthetic source file\n" % i
+                    for i in range(2048))
+    src_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    chunk = file_mb * 1024 * 1024
+    try:
+        with tarfile.open(path, "w") as tar:
+            for i in range(max(1, size_mb // file_mb)):
+                name = os.path.join(src_dir, "file%05d.bin" % i)
+                with open(name, "wb") as f:
+                    written = 0
+                    while written < chunk:
+                        data = os.urandom(64 * 1024) + text
+                        f.write(data)
+                        written += len(data)
+                tar.add(name, arcname="data/" + os.path.basename(name))
+                os.remove(name)
+    finally:
+        shutil.rmtree(src_dir)
+
+
+def compress(tar_path, fmt):
+    for command in compressors[fmt]:
+        if archive._find_executable(command[0]) is not None:
+            out_path = tar_path + "." + fmt
+            with open(tar_path, "rb") as src:
+                with open(out_path, "wb") as dst:
+                    subprocess.check_call(command, stdin=src, stdout=dst)
+            return out_path
+    return None
+
+
+def measure(path, work_dir, external):
+    archive.use_external_decompressors = external
+    dst = tempfile.mkdtemp(dir=work_dir)
+    try:
+        start = time.time()
+        archive.extract(path, dst)
+        return time.time() - start
+    finally:
+        shutil.rmtree(dst)
+        archive.use_external_decompressors = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the archive extraction backends")
+    parser.add_argument("--size", type=int, default=500,
+                        help="size of the uncompressed tarball in MB")
+    parser.add_argument("--formats", default="gz,bz2,xz,zst",
+                        help="comma separated compression formats")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of runs per backend, the best counts")
+    parser.add_argument("--work-dir", default=None,
+                        help="directory for the temporary files")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        tar_path = os.path.join(work_dir, "synthetic.tar")
+        print("Generating a {} MB tarball in {}".format(args.size, work_dir))
+        generate_tar(tar_path, args.size)
+        size_mb = os.path.getsize(tar_path) / (1024.0 * 1024.0)
+
+        print("{:<6} {:<16} {:>10} {:>10}".format("format", "backend",
+                                                  "seconds", "MB/s"))
+        for fmt in args.formats.split(","):
+            path = compress(tar_path, fmt.strip())
+            if path is None:
+                print("{:<6} no compressor available".format(fmt))
+                continue
+            backends = [("python", False)]
+            command = archive.get_decompressor(path)
+            if command is not None:
+                backends.append((" ".join(command), True))
+            for name, external in backends:
+                try:
+                    seconds = min(measure(path, work_dir, external)
+                                  for i in range(args.repeat))
+                except archive.ArchiveException as exc:
+                    print("{:<6} {:<16} {}".format(fmt, name, exc))
+                    continue
+                print("{:<6} {:<16} {:>10.2f} {:>10.1f}".format(
+                    fmt, name, seconds, size_mb / seconds))
+            os.remove(path)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
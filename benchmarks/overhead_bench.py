@@ -0,0 +1,351 @@
+#! /usr/bin/env python2
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file overhead_bench.py
+# \brief Measure the overhead of the build scripts with local stand-ins
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+#
+# A synthetic workspace is generated in a temporary directory:
+# a targets/ tree with families x modules x boards devices, local bare
+# git repositories registered as submodules of the sources superproject,
+# binaries served by a local HTTP server and a stub make printing a few
+# lines. The build script steps are then called directly and timed.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+
+try:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import utils
+import target
+import cache
+
+STEPS = ("list_devices", "parse_all", "parse_all_cached", "fetch", "build",
+         "build_up_to_date", "get_binaries", "copyfiles")
+
+STUB_MAKE = """#!/bin/sh
+# stand-in for make, prints some output like a quiet build would
+for i in $(seq 1 %d); do echo "  CC      file$i.o"; done
+case "$1" in
+    all) echo "$(pwd)" > "$(basename "$(pwd)").bin" ;;
+esac
+"""
+
+GIT_ENV = {"GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@localhost",
+           "GIT_COMMITTER_NAME": "bench",
+           "GIT_COMMITTER_EMAIL": "bench@localhost",
+           "GIT_ALLOW_PROTOCOL": "file"}
+
+
+class StepError(Exception):
+    pass
+
+
+def git(args, cwd):
+    env = dict(os.environ, **GIT_ENV)
+    subprocess.check_call(["git"] + args,
+                          cwd=cwd, env=env, stdout=open(os.devnull, "w"),
+                          stderr=subprocess.STDOUT)
+
+
+def allow_file_protocol():
+    # the local remotes are cloned by the git calls of the build scripts
+    # too, e.g. git submodule update, git >= 2.38.1 refuses them unless
+    # the file transport is allowed; older versions ignore the setting
+    count = int(os.environ.get("GIT_CONFIG_COUNT", "0"))
+    os.environ["GIT_CONFIG_KEY_%d" % count] = "protocol.file.allow"
+    os.environ["GIT_CONFIG_VALUE_%d" % count] = "always"
+    os.environ["GIT_CONFIG_COUNT"] = str(count + 1)
+
+
+class Workspace:
+    def __init__(self, path, families, modules, boards, targets,
+                 output_lines, http_url):
+        self.path = path
+        self.targets = ["target%d" % i for i in range(targets)]
+        self.devices = []
+        self.http_url = http_url
+
+        # stub tools
+        bin_path = path + "/stubs"
+        os.makedirs(bin_path)
+        with open(bin_path + "/make", "w") as f:
+            f.write(STUB_MAKE % output_lines)
+        os.chmod(bin_path + "/make", 0o755)
+        os.environ["PATH"] = bin_path + os.pathsep + os.environ["PATH"]
+        allow_file_protocol()
+
+        # remote repositories and the sources superproject, copied
+        # before every fetch
+        remotes = path + "/remotes"
+        self.template = path + "/sources-template"
+        os.makedirs(self.template)
+        git(["init", "-q"], self.template)
+        for name in self.targets:
+            work = remotes + "/work-" + name
+            os.makedirs(work)
+            git(["init", "-q"], work)
+            with open(work + "/Makefile", "w") as f:
+                f.write("all:\n\t@true\n")
+            git(["add", "-A"], work)
+            git(["commit", "-q", "-m", "init"], work)
+            git(["clone", "-q", "--bare", work, remotes + "/" + name + ".git"],
+                remotes)
+            git(["submodule", "add", "-q", remotes + "/" + name + ".git",
+                 name], self.template)
+        git(["commit", "-q", "-m", "submodules"], self.template)
+        for name in self.targets:
+            git(["submodule", "deinit", "-q", "-f", name], self.template)
+        shutil.rmtree(self.template + "/.git/modules")
+
+        # binaries
+        http_root = path + "/http"
+        os.makedirs(http_root)
+        with tarfile.open(http_root + "/bins.tar.gz", "w:gz") as tar:
+            for name in ("fpga.bit", "fsbl.elf"):
+                with open(path + "/" + name, "wb") as f:
+                    f.write(os.urandom(1024 * 1024))
+                tar.add(path + "/" + name, arcname=name)
+
+        # targets tree
+        with open(self.mkdir(path + "/targets") + "/build.ini", "w") as f:
+            f.write("[toolchains]\n")
+        for fam in range(families):
+            for mod in range(modules):
+                for board in range(boards):
+                    device = "Fam%d/Mod%d/Board%d/SD" % (fam, mod, board)
+                    self.devices.append(device)
+                    dev_path = self.mkdir(path + "/targets/" + device)
+                    with open(dev_path + "/build.ini", "w") as f:
+                        f.write(self.get_device_ini())
+
+    @staticmethod
+    def mkdir(path):
+        os.makedirs(path)
+        return path
+
+    def get_device_ini(self):
+        lines = ["[targets]"]
+        lines += [name + " = true" for name in self.targets]
+        for priority, name in enumerate(self.targets):
+            lines += ["", "[" + name + "]", "repository = " + name,
+                      "priority = " + str(priority + 1), "branch = master",
+                      "", "[" + name + "-parallelbuild]",
+                      "defconfig = make defconfig", "build = make all",
+                      "", "[" + name + "-copyfiles]",
+                      name + ".bin = " + name + ".bin"]
+        lines += ["", "[binaries]", "set1 = true", "", "[set1]",
+                  "url = " + self.http_url + "/bins.tar.gz", "unpack = true",
+                  "description = Set one", "", "[set1-copyfiles]",
+                  "fpga.bit = fpga.bit", "fsbl.elf = fsbl.elf", ""]
+        return "\n".join(lines)
+
+    def reset_sources(self):
+        sources = self.path + "/sources"
+        if os.path.isdir(sources):
+            shutil.rmtree(sources)
+        shutil.copytree(self.template, sources, symlinks=True)
+
+
+def start_http_server(root):
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(root, path.split("?")[0].lstrip("/"))
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def measure(function, repeat, setup=None):
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_scale(work_dir, scale, args):
+    families, modules, boards = [int(n) for n in scale.split("x")]
+    path = tempfile.mkdtemp(dir=work_dir)
+    # the files are served from the directory created by Workspace
+    server = start_http_server(path + "/http")
+    stdout = sys.stdout
+    try:
+        ws = Workspace(path, families, modules, boards, args.targets,
+                       args.output_lines,
+                       "http://127.0.0.1:%d" % server.server_address[1])
+        u = utils.Utils()
+        # the output is written as usual, but it is not shown
+        sys.stdout = open(os.devnull, "w")
+        master_repo_path = path + "/sources"
+        parse_cache = path + "/cache/targets"
+
+        def new_target(device, parse_cache=None):
+            return target.Target(path, master_repo_path,
+                                 path + "/targets/" + device,
+                                 u.get_ini_files(path, device),
+                                 device.replace("/", "_"), False, u, None,
+                                 "master", False, parse_cache=parse_cache)
+
+        def parse_all(parse_cache=None):
+            for device in ws.devices:
+                new_target(device, parse_cache)
+
+        results = dict()
+
+        def step(name, function, setup=None):
+            # the numbers of a failing step are meaningless, and so are
+            # the ones of the steps depending on it; failed fetches are
+            # only reported as warnings
+            results[name] = measure(function, args.repeat, setup)
+            if u.get_error_count() or u.get_warning_count():
+                raise StepError("Errors in step " + name + " of scale " +
+                                scale)
+
+        step("list_devices", lambda: u.get_devices(path))
+        step("parse_all", parse_all)
+        parse_all(parse_cache)
+        step("parse_all_cached", lambda: parse_all(parse_cache))
+
+        t = new_target(ws.devices[0])
+        t.set_binaries(t.get_default_binary())
+        t.out_dir = path + "/out"
+        os.makedirs(t.out_dir)
+
+        def fetch_setup():
+            ws.reset_sources()
+            t.set_fetch(ws.targets)
+            t.set_build(ws.targets)
+
+        step("fetch", lambda: t.do_fetch(True, True, args.jobs), fetch_setup)
+        step("build", lambda: t.do_build([], args.jobs, 0,
+                                         force_rebuild=True))
+        t.do_copyfiles(args.jobs)
+        step("build_up_to_date", lambda: t.do_build([], args.jobs, 0))
+
+        def binaries_setup():
+            for name in ("binaries", "cache"):
+                if os.path.isdir(path + "/" + name):
+                    shutil.rmtree(path + "/" + name)
+            os.makedirs(path + "/binaries")
+
+        download_cache = cache.DownloadCache(path + "/cache", 0, u)
+        step("get_binaries",
+             lambda: t.do_get_binaries(path + "/binaries", download_cache),
+             binaries_setup)
+
+        def copy_setup():
+            shutil.rmtree(t.out_dir)
+            os.makedirs(t.out_dir)
+
+        step("copyfiles", lambda: t.do_copyfiles(args.jobs), copy_setup)
+        return results
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        server.shutdown()
+        shutil.rmtree(path)
+
+
+def compare(results, baseline, threshold, noise):
+    regressions = []
+    for scale, steps in sorted(results.items()):
+        for step in STEPS:
+            old = baseline.get(scale, {}).get(step)
+            new = steps.get(step)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > noise:
+                regressions.append((scale, step, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the overhead of the build scripts")
+    parser.add_argument("--scales", default="1x1x1,2x4x4,4x8x8",
+                        help="comma separated families x modules x boards")
+    parser.add_argument("--targets", type=int, default=3,
+                        help="number of targets per device")
+    parser.add_argument("--output-lines", type=int, default=1000,
+                        help="lines printed by every make call")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="number of fetch, build and copy jobs")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs per step, the best counts")
+    parser.add_argument("--work-dir", default=None,
+                        help="directory for the temporary files")
+    parser.add_argument("--save-baseline", metavar="file",
+                        help="store the results as the baseline")
+    parser.add_argument("--baseline", metavar="file",
+                        help="compare the results with the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--noise", type=float, default=0.01,
+                        help="slowdown in seconds always ignored")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    results = dict()
+    try:
+        print("{:<8} {:<18} {:>10}".format("scale", "step", "seconds"))
+        for scale in args.scales.split(","):
+            results[scale] = run_scale(work_dir, scale.strip(), args)
+            for step in STEPS:
+                print("{:<8} {:<18} {:>10.3f}".format(scale, step,
+                                                      results[scale][step]))
+    except StepError as exc:
+        # no baseline is saved or compared with failed steps
+        print(str(exc) + ", the results are not used", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.noise)
+        for scale, step, old, new in regressions:
+            print("REGRESSION {} {}: {:.3f} s -> {:.3f} s".format(
+                scale, step, old, new))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,9 +38,16 @@ try:
     import time
     import datetime
     import re
+    import json
+    import atexit
+    import multiprocessing
     from stat import S_ISREG, ST_MTIME, ST_MODE
 
     import target
+    import cache
+    import mirror
+    import ccache
+    import batch
     import glob
     import gui
 
@@ -65,6 +72,7 @@ state = "INIT"
 init_state = "INIT"
 done = False
 build_log_file = None
+build_trace_file = None
 tool_name = "Enclustra Build Environment"
 def_fname = None
 project_file = None
@@ -108,6 +116,22 @@ parser.add_argument("--list-devices-raw", action='store_true',
                     required=False, dest='list_devices_raw',
                     help='list all available devices in a script friendly way')
 
+parser.add_argument("--dump-matrix", action='store_true', required=False,
+                    dest='dump_matrix',
+                    help='print the targets and binary options of all'
+                    ' devices (or all devices below the one given with -d)'
+                    ' as JSON, one device per line')
+
+parser.add_argument("--devices-file", action='store', required=False,
+                    dest='devices_file', metavar='file',
+                    help='build the default configuration of all devices'
+                    ' listed in the file, one per line')
+
+parser.add_argument("--all-devices", action='store_true', required=False,
+                    dest='all_devices',
+                    help='build the default configuration of all devices'
+                    ' (or all devices below the one given with -d)')
+
 parser.add_argument("-d", "--device", action='store', required=False,
                     dest='device', metavar='device',
                     help='specify device as follows: \
@@ -197,6 +221,25 @@ parser.add_argument("-C", "--clean-soft", action='store_true',
                     help='run clean commands for all specified targets'
                     ' (if available)')
 
+parser.add_argument("--force-rebuild", action='store_true', required=False,
+                    dest='force_rebuild',
+                    help='build all the subtargets, even if they are up to'
+                    ' date')
+
+parser.add_argument("--trace-out", action='store', required=False,
+                    dest='trace_out', metavar='file',
+                    help='write a timeline of the run in the Chrome trace'
+                    ' format (chrome://tracing, Perfetto)')
+
+parser.add_argument("--cache-stats", action='store_true', required=False,
+                    dest='cache_stats',
+                    help='print statistics of the download cache')
+
+parser.add_argument("--verify-cache", action='store_true', required=False,
+                    dest='verify_cache',
+                    help='check the checksums of all the files in the download'
+                    ' cache and delete the corrupted ones')
+
 parser.add_argument("-v", "--version", action='store_true', required=False,
                     dest='version',
                     help='print version')
@@ -213,7 +256,6 @@ try:
     # see if we should auto-determine it (use nproc + 1)
     if nthreads == "auto":
         try:
-            import multiprocessing
             nthreads = multiprocessing.cpu_count() + 1
         except:
             nthreads = nthreads_default
@@ -230,7 +272,96 @@ try:
             utils.print_message(utils.logtype.WARNING,
                                 msg.format(nthreads))
 
+    # get number of targets to fetch in parallel
+    fetch_jobs_default = 4
+    fetch_jobs = fetch_jobs_default
+    if config.has_option('general', 'fetch_jobs'):
+        try:
+            fetch_jobs = int(config['general']['fetch_jobs'])
+            if fetch_jobs <= 0:
+                raise ValueError
+        except ValueError:
+            fetch_jobs = fetch_jobs_default
+            msg = "Invalid fetch jobs configuration - using {} jobs"
+            utils.print_message(utils.logtype.WARNING,
+                                msg.format(fetch_jobs))
+
+    # get number of targets to build in parallel (0 means no limit)
+    build_jobs = 0
+    if config.has_option('general', 'build_jobs'):
+        build_jobs = config['general']['build_jobs']
+        if build_jobs == "auto":
+            build_jobs = 0
+        else:
+            try:
+                build_jobs = int(build_jobs)
+                if build_jobs < 0:
+                    raise ValueError
+            except ValueError:
+                build_jobs = 0
+                msg = "Invalid build jobs configuration - building all" \
+                      " independent targets in parallel"
+                utils.print_message(utils.logtype.WARNING, msg)
+
+    # get number of devices to build in parallel in batch mode
+    batch_jobs_default = 2
+    batch_jobs = batch_jobs_default
+    if config.has_option('general', 'batch_jobs'):
+        try:
+            batch_jobs = int(config['general']['batch_jobs'])
+            if batch_jobs <= 0:
+                raise ValueError
+        except ValueError:
+            batch_jobs = batch_jobs_default
+            msg = "Invalid batch jobs configuration - using {} jobs"
+            utils.print_message(utils.logtype.WARNING,
+                                msg.format(batch_jobs))
+
     history_path = config['general']['history_path']
+
+    # setup the download cache shared by all workspaces
+    cache_dir = os.path.expanduser("~") + "/.ebe/cache"
+    if config.has_option('general', 'cache_dir'):
+        cache_dir = os.path.expanduser(config['general']['cache_dir'])
+    cache_size_default = "10G"
+    cache_size = cache_size_default
+    if config.has_option('general', 'cache_size'):
+        cache_size = config['general']['cache_size']
+    try:
+        cache_size = cache.DownloadCache.parse_size(cache_size)
+    except ValueError:
+        cache_size = cache.DownloadCache.parse_size(cache_size_default)
+        msg = "Invalid cache size configuration - using {}"
+        utils.print_message(utils.logtype.WARNING,
+                            msg.format(cache_size_default))
+    download_cache = cache.DownloadCache(cache_dir, cache_size, utils)
+    # parsed target descriptors, see target.Target
+    parse_cache = cache_dir + "/targets"
+
+    # compiler cache shared by all workspaces, disabled by default
+    if config.has_option('general', 'ccache_dir'):
+        compiler_cache = ccache.CompilerCache(
+            os.path.expanduser(config['general']['ccache_dir']),
+            config['general'].get('ccache_size'), utils)
+        if compiler_cache.is_available():
+            utils.set_compiler_cache(compiler_cache)
+        else:
+            utils.print_message(utils.logtype.WARNING,
+                                "ccache not found - building without",
+                                "the compiler cache")
+
+    # local mirrors used as reference when fetching the targets
+    reference_mirrors = None
+    if config.has_option('general', 'git_reference_dir'):
+        git_reference_dir = os.path.expanduser(
+            config['general']['git_reference_dir'])
+        git_reference_dissociate = True
+        if config.has_option('general', 'git_reference_dissociate'):
+            git_reference_dissociate = config.getboolean(
+                'general', 'git_reference_dissociate')
+        reference_mirrors = mirror.ReferenceMirrors(git_reference_dir,
+                                                    git_reference_dissociate,
+                                                    utils)
     debug_calls = config.getboolean('debug', 'debug-calls')
     utils.set_debug_calls(debug_calls)
     quiet_mode = config.getboolean('debug', 'quiet-mode')
@@ -246,6 +377,17 @@ try:
                                 build_log, "for writing. Error:", str(ext))
             build_log_file = None
         utils.set_log_file(build_log_file)
+        # the timing of the steps is written next to the log
+        if build_log_file is not None:
+            trace_path = os.path.splitext(root_path + '/' + build_log)[0]
+            try:
+                build_trace_file = open(trace_path + '.spans.jsonl', 'w')
+                utils.timing.set_trace_file(build_trace_file)
+            except Exception as ext:
+                utils.print_message(utils.logtype.WARNING,
+                                    "Could not open file", trace_path +
+                                    ".spans.jsonl for writing. Error:",
+                                    str(ext))
 
     for toolchain in config['toolchains']:
         utils.register_toolchain(registered_toolchains, toolchain, config,
@@ -258,6 +400,10 @@ except Exception as ext:
 
 args = parser.parse_args()
 
+if args.trace_out is not None:
+    # written at exit, also when the run is aborted
+    atexit.register(utils.timing.write_chrome_trace, args.trace_out)
+
 if args.disable_colors is True:
     utils.set_colors(False)
 
@@ -303,6 +449,47 @@ if args.version is True:
     print(str("\n" + tool_version + "\n"))
     sys.exit(0)
 
+elif args.cache_stats is True:
+    download_cache.print_stats()
+    sys.exit(0)
+
+elif args.verify_cache is True:
+    # hashing releases the GIL, so the objects are checked in parallel
+    if download_cache.verify(int(nthreads)):
+        sys.exit(1)
+    sys.exit(0)
+
+elif args.dump_matrix is True:
+    devices = utils.get_devices(root_path, args.device or "")
+    jobs = [(root_path, master_repo_path, d, release, parse_cache)
+            for d in devices]
+    pool = multiprocessing.Pool(int(nthreads),
+                                target.init_describe_worker)
+    try:
+        # the devices are parsed in parallel, printed in order
+        for record in pool.imap(target.describe_device, jobs):
+            print(json.dumps(record, sort_keys=True))
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
+    sys.exit(0)
+
+elif args.devices_file is not None or args.all_devices is True:
+    if args.devices_file is not None:
+        try:
+            batch_devices = batch.Batch.read_devices_file(args.devices_file)
+        except IOError as e:
+            utils.print_message(utils.logtype.ERROR,
+                                "Could not read the devices file:", str(e))
+            sys.exit(1)
+    else:
+        batch_devices = sorted(utils.get_devices(root_path,
+                                                 args.device or ""))
+    if not batch_devices:
+        utils.print_message(utils.logtype.ERROR, "No devices to build")
+        sys.exit(1)
+    state = "BATCH"
+
 elif args.clean_all is True:
     utils.print_message(utils.logtype.INFO, "Cleaning ...")
     utils.remove_folder(root_path + "/bin")
@@ -312,7 +499,8 @@ elif args.clean_all is True:
     # get all the output dirs
     dirs = [name for name in os.listdir(root_path) if
             os.path.isdir(os.path.join(root_path, name))]
-    out_dirs = filter(lambda pref: 'out_' in pref, dirs)
+    out_dirs = filter(lambda pref: 'out_' in pref or
+                      pref.startswith('build_'), dirs)
     for directory in out_dirs:
         utils.remove_folder(root_path + "/" + directory)
     utils.print_message(utils.logtype.INFO, "Done.")
@@ -336,7 +524,7 @@ elif args.saved_config is not None:
     t = target.Target(root_path, master_repo_path, "",
                       args.saved_config, "No name",
                       debug_calls, utils, history_path,
-                      release, True)
+                      release, True, parse_cache=parse_cache)
 
     # binaries have to be set by hand
     if t.config.has_section("binaries") is True:
@@ -377,7 +565,7 @@ elif args.build_project is not None or args.build_project_auto is not None:
                       project_file, "No name",
                       debug_calls, utils,
                       os.path.dirname(project_file),
-                      release, True)
+                      release, True, parse_cache=parse_cache)
 
     setup_output_dir(t, utils, os.path.dirname(project_file))
 
@@ -395,18 +583,11 @@ elif args.build_project is not None or args.build_project_auto is not None:
 elif args.device is not None:
     # initialize target
     dev_path = root_path + "/targets/" + args.device
-    parse_dir = root_path + "/targets"
-    ini_files = list()
-    if os.path.isfile(parse_dir + "/build.ini"):
-        ini_files.append(parse_dir + "/build.ini")
-    for directory in (str(args.device)).split("/"):
-        parse_dir += "/" + directory
-        if not os.path.exists(parse_dir):
-            utils.print_message(utils.logtype.ERROR, "device argument "
-                                "not supported: " + str(directory))
-            sys.exit(1)
-        if os.path.isfile(parse_dir + "/build.ini"):
-            ini_files.append(parse_dir + "/build.ini")
+    try:
+        ini_files = utils.get_ini_files(root_path, args.device)
+    except ValueError as e:
+        utils.print_message(utils.logtype.ERROR, str(e))
+        sys.exit(1)
 
     # check if user wants to list subdirs for the given device
     if args.list_devices:
@@ -429,7 +610,7 @@ elif args.device is not None:
     device_name = (str(args.device)).replace("/", "_").replace(" ", "_")
     t = target.Target(root_path, master_repo_path, dev_path, ini_files,
                       device_name, debug_calls, utils, history_path,
-                      release, False)
+                      release, False, parse_cache=parse_cache)
     # if list only
     if args.list_targets is True:
         targets_list = t.get_build()
@@ -580,9 +761,11 @@ else:
     # if we're in gui mode add dialog to tools list
     required_tools += (["dialog", "--version", 2, "1.1-20120215"], )
 
-# check tools
+# check tools, the versions are probed in parallel and cached
+tool_versions = utils.probe_tools(required_tools, os.path.expanduser("~") +
+                                  "/.ebe/toolcheck.json")
 for tool in required_tools:
-    if utils.check_tool(tool[0], tool[1], tool[2], tool[3]) is False:
+    if not utils.is_version_at_least(tool_versions[tool[0]], tool[3]):
         utils.print_message(utils.logtype.ERROR, "Version of", tool[0],
                             "has to be", tool[3], "or greater!")
         utils.print_message(utils.logtype.INFO, "For more information,"
@@ -591,9 +774,9 @@ for tool in required_tools:
         sys.exit(1)
 
 # Git before version 1.8.4 didn't support submodule shallow clone
-git_use_depth = utils.check_tool("git", "--version", 3, "1.8.4")
+git_use_depth = utils.is_version_at_least(tool_versions["git"], "1.8.4")
 # Git before version 1.8.1.6 didn't use the '--remote' switch in submodules
-git_use_remote = utils.check_tool("git", "--version", 3, "1.8.1.6")
+git_use_remote = utils.is_version_at_least(tool_versions["git"], "1.8.1.6")
 
 # create required folder
 try:
@@ -609,6 +792,27 @@ welcome_msg = tool_version
 # if log file is set this will be logged
 utils.print_message(utils.logtype.INFO, welcome_msg + "\n\n")
 
+if state == "BATCH":
+    settings = {"root_path": root_path,
+                "master_repo_path": master_repo_path,
+                "release": release,
+                "parse_cache": parse_cache,
+                "history_path": history_path,
+                "cache_dir": cache_dir,
+                "cache_size": cache_size,
+                "nthreads": nthreads,
+                "build_jobs": build_jobs,
+                "force_rebuild": args.force_rebuild,
+                "debug_calls": debug_calls,
+                "quiet_mode": quiet_mode,
+                "break_on_error": break_on_error}
+    b = batch.Batch(settings, utils, download_cache, registered_toolchains)
+    failed = b.run(batch_devices, git_use_depth, git_use_remote, fetch_jobs,
+                   reference_mirrors, batch_jobs)
+    for line in utils.timing.get_summary():
+        utils.print_message(utils.logtype.INFO, line)
+    sys.exit(1 if failed else 0)
+
 # Main loop
 g = None
 binary_path = ""
@@ -652,7 +856,8 @@ while done is False:
                 t = target.Target(root_path, master_repo_path, g.get_workdir(),
                                   dirpath + tag + ".ini", "No name",
                                   debug_calls, utils, history_path,
-                                  release, used_previous_config)
+                                  release, used_previous_config,
+                                  parse_cache=parse_cache)
 
                 # binaries have to be set by hand
                 if t.config.has_section("binaries") is True:
@@ -688,7 +893,7 @@ while done is False:
             t = target.Target(root_path, master_repo_path, g.get_workdir(),
                               g.get_inifiles(), g.get_target_name(),
                               debug_calls, utils, history_path, release,
-                              used_previous_config)
+                              used_previous_config, parse_cache=parse_cache)
 
     elif state == "FETCH_MENU":
         fetch_list = t.get_fetch()
@@ -713,6 +918,7 @@ while done is False:
                 code, tags = g.show_fetch_opts_menu(t.get_fetch_opts())
                 if code == "ok":
                     t.set_fetch_opts(tags)
+                    t.set_fetch_modes(tags)
             continue
 
     elif state == "BUILD_MENU":
@@ -872,7 +1078,15 @@ while done is False:
         # clear console
         if g:
             subprocess.call("clear")
-        t.do_fetch(git_use_depth, git_use_remote)
+        # the downloads do not depend on the sources, they run in the
+        # background until the toolchains or binaries are needed
+        utils.prefetch_toolchains(t.get_required_toolchains(),
+                                  registered_toolchains, root_path,
+                                  download_cache)
+        t.prefetch_binaries(download_cache)
+        with utils.timing.span("fetch"):
+            t.do_fetch(git_use_depth, git_use_remote, fetch_jobs,
+                       reference_mirrors)
         state = "DO_GET_TOOLCHAIN"
 
     elif state == "DO_GET_TOOLCHAIN":
@@ -881,9 +1095,10 @@ while done is False:
 
         required_toolchains = t.get_required_toolchains()
         try:
-            toolchains_paths = utils.acquire_toolchains(required_toolchains,
-                                                        registered_toolchains,
-                                                        root_path, debug_calls)
+            with utils.timing.span("toolchains"):
+                toolchains_paths = utils.acquire_toolchains(
+                    required_toolchains, registered_toolchains, root_path,
+                    debug_calls, download_cache)
         except Exception as ex:
             utils.print_message(utils.logtype.ERROR,
                                 "Failed to acquire toolchain, skipping build!",
@@ -903,7 +1118,13 @@ while done is False:
         sys.exit(0)
 
     elif state == "DO_BUILD":
-        t.do_build(toolchains_paths, nthreads)
+        if utils.compiler_cache is not None:
+            ccache_stats = utils.compiler_cache.get_stats()
+        with utils.timing.span("build"):
+            t.do_build(toolchains_paths, nthreads, build_jobs,
+                       args.force_rebuild)
+        if utils.compiler_cache is not None:
+            utils.compiler_cache.print_stats(ccache_stats)
         state = "HANDLE_BINARIES"
 
     elif state == "HANDLE_BINARIES":
@@ -911,12 +1132,14 @@ while done is False:
         if t.fetch_only_run():
             continue
         binaries_path = root_path + "/binaries"
-        t.do_get_binaries(binaries_path)
+        with utils.timing.span("binaries"):
+            t.do_get_binaries(binaries_path, download_cache)
 
     elif state == "DO_COPYFILES":
         utils.print_message(utils.logtype.INFO,
                             "Working directory: " + root_path)
-        t.do_copyfiles()
+        with utils.timing.span("copy files"):
+            t.do_copyfiles(int(nthreads))
         state = "DO_IMAGE_GEN"
 
     elif state == "DO_IMAGE_GEN":
@@ -926,7 +1149,8 @@ while done is False:
         try:
             toolchains = utils.acquire_toolchains(required_toolchains,
                                                   registered_toolchains,
-                                                  root_path, debug_calls)
+                                                  root_path, debug_calls,
+                                                  download_cache)
         except Exception as ex:
             utils.print_message(utils.logtype.ERROR,
                                 "Failed to acquire toolchain, skipping build!",
@@ -934,7 +1158,8 @@ while done is False:
             done = True
             continue
 
-        t.do_generate_image(t.out_dir, toolchains)
+        with utils.timing.span("bootimages"):
+            t.do_generate_image(t.out_dir, toolchains)
         if project_mode_save or (project_file is not None):
             state = "GENERATE_PROJECT"
         else:
@@ -977,6 +1202,9 @@ if done:
             msg_type = utils.logtype.WARNING
         utils.print_message(msg_type, msg)
 
+    for line in utils.timing.get_summary():
+        utils.print_message(utils.logtype.INFO, line)
+
     for line in t.get_summary(oneline=True).split("\n"):
         utils.print_message(utils.logtype.INFO, line)
 
@@ -986,6 +1214,8 @@ if done:
 
 if build_log_file is not None:
     build_log_file.close()
+if build_trace_file is not None:
+    build_trace_file.close()
 
 # non-zero exit code in case of errors
 if utils.get_error_count():
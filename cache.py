@@ -0,0 +1,535 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file cache.py
+# \brief Enclustra Build Environment download cache class
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+import os
+import re
+import json
+import time
+import fcntl
+import errno
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class DownloadError(Exception):
+    """Error raised when a file could not be downloaded."""
+
+
+class ChecksumError(DownloadError):
+    """Error raised when a file does not have the expected checksum."""
+
+
+class HashingReader(object):
+    """
+    File object hashing everything read from the wrapped file object
+    and writing a copy of it to another file.
+    """
+
+    def __init__(self, fileobj, sha256, copy_file=None):
+        self.fileobj = fileobj
+        self.sha256 = sha256
+        self.copy_file = copy_file
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if not data and size != 0:
+            self.eof = True
+        self.sha256.update(data)
+        if self.copy_file is not None:
+            self.copy_file.write(data)
+        return data
+
+    def drain(self, chunk_size):
+        while self.read(chunk_size):
+            pass
+
+
+class DownloadCache:
+    """
+    Cache of downloaded files shared by all the workspaces of a user.
+
+    Every downloaded file is stored once, under its SHA-256 checksum.
+    The index maps the URLs to the checksums and keeps the validators
+    (ETag, Last-Modified) used to check if the remote file changed.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, cache_path, max_size, utils):
+        self.cache_path = cache_path
+        self.objects_path = cache_path + "/objects"
+        self.index_path = cache_path + "/index.json"
+        self.lock_path = cache_path + "/index.lock"
+        # maximal size of the cache in bytes, 0 means no limit
+        self.max_size = max_size
+        self.utils = utils
+        self.lock = threading.Lock()
+        # downloads started in the background, by url
+        self.prefetches = dict()
+        self.prefetch_lock = threading.Lock()
+
+    @staticmethod
+    def parse_size(size):
+        units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3,
+                 "T": 1024 ** 4}
+        match = re.match(r"^\s*(\d+)\s*([KMGT]?)i?B?\s*$", size.upper())
+        if match is None:
+            raise ValueError("Invalid size: " + size)
+        return int(match.group(1)) * units[match.group(2)]
+
+    def get_object_path(self, sha256):
+        return self.objects_path + "/" + sha256[:2] + "/" + sha256
+
+    class index_lock:
+        """Context manager locking the index for the current process
+        and for the other processes using the same cache"""
+        def __init__(self, cache):
+            self.cache = cache
+
+        def __enter__(self):
+            self.cache.lock.acquire()
+            try:
+                self.cache.utils.mkdir_p(self.cache.cache_path)
+                self.lock_file = open(self.cache.lock_path, "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            except:
+                self.cache.lock.release()
+                raise
+
+        def __exit__(self, etype, value, traceback):
+            self.lock_file.close()
+            self.cache.lock.release()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError):
+            index = dict()
+        index.setdefault("entries", dict())
+        index.setdefault("hits", 0)
+        index.setdefault("misses", 0)
+        return index
+
+    def save_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump(index, index_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def prefetch(self, url, revalidate=True, force=False, sha256=None,
+                 consumer=None):
+        """
+        Start fetching url in the background. The first fetch of the same
+        url waits for it and uses its result instead of fetching again.
+
+        If consumer is given, it is called in the background like by
+        fetch and the consumer of the waiting fetch is not called again.
+        """
+        with self.prefetch_lock:
+            if url in self.prefetches:
+                return
+            prefetch = Prefetch(self, url, revalidate, force, sha256,
+                                consumer)
+            self.prefetches[url] = prefetch
+        prefetch.start()
+
+    def fetch(self, url, revalidate=True, force=False, consumer=None,
+              sha256=None):
+        """
+        Return a tuple (path, updated) with the path of the cached copy
+        of url and a flag telling if it was downloaded in this call.
+        The cached copy is revalidated with the server if revalidate
+        is set, and downloaded unconditionally if force is set.
+
+        If consumer is given, it is called with a file object to read
+        the contents from. A file which is not cached yet is passed
+        to the consumer while it is being downloaded, so it is read
+        only once.
+
+        If sha256 is given, the file must have this checksum. It is
+        checked while the file is read, ChecksumError is raised if it
+        does not match.
+        """
+        if sha256 is not None:
+            sha256 = sha256.strip().lower()
+        with self.prefetch_lock:
+            prefetch = self.prefetches.pop(url, None)
+        if prefetch is not None:
+            object_path, updated = prefetch.wait()
+            if not prefetch.consumed:
+                self.consume_verified(url, object_path, consumer, sha256)
+            return object_path, updated
+        return self.fetch_object(url, revalidate, force, consumer, sha256)
+
+    def fetch_object(self, url, revalidate, force, consumer, sha256):
+        with self.index_lock(self):
+            entry = self.load_index()["entries"].get(url)
+        if entry is not None and \
+                not os.path.isfile(self.get_object_path(entry["sha256"])):
+            entry = None
+        if entry is not None and sha256 is not None and \
+                entry["sha256"] != sha256:
+            # the expected file changed, the cached copy is outdated
+            entry = None
+            force = True
+
+        if sha256 is not None and not force and \
+                os.path.isfile(self.get_object_path(sha256)):
+            # the objects are stored under their checksum, so the expected
+            # file is already there, maybe downloaded from another url
+            if entry is None:
+                entry = dict()
+                entry["sha256"] = sha256
+                entry["size"] = os.path.getsize(self.get_object_path(sha256))
+            revalidate = False
+
+        if entry is not None and not force and not revalidate:
+            self.update_entry(url, entry, hit=True)
+            object_path = self.get_object_path(entry["sha256"])
+            self.consume_verified(url, object_path, consumer, sha256)
+            return object_path, False
+
+        headers = []
+        if entry is not None and not force:
+            if entry.get("etag"):
+                headers.append("If-None-Match: " + entry["etag"])
+            if entry.get("last_modified"):
+                headers.append("If-Modified-Since: " + entry["last_modified"])
+
+        # a conditional request may end up with no contents at all,
+        # so only unconditional downloads are streamed to the consumer
+        stream_consumer = consumer if not headers else None
+        with self.utils.timing.span("download " + os.path.basename(url)):
+            status, tmp_path, downloaded_sha256, response = self.download(
+                url, headers, stream_consumer)
+        if status == 304:
+            self.update_entry(url, entry, hit=True)
+            object_path = self.get_object_path(entry["sha256"])
+            self.consume_verified(url, object_path, consumer, sha256)
+            return object_path, False
+
+        if sha256 is not None and sha256 != downloaded_sha256:
+            os.remove(tmp_path)
+            raise ChecksumError("Checksum of " + url + " does not match: "
+                                "expected " + sha256 + ", got " +
+                                downloaded_sha256)
+
+        entry = dict()
+        entry["sha256"] = downloaded_sha256
+        entry["size"] = os.path.getsize(tmp_path)
+        entry["etag"] = response.get("etag")
+        entry["last_modified"] = response.get("last-modified")
+
+        object_path = self.get_object_path(downloaded_sha256)
+        self.utils.mkdir_p(os.path.dirname(object_path))
+        if os.path.isfile(object_path):
+            # the same content is already cached under another url
+            os.remove(tmp_path)
+        else:
+            # cached objects are never modified in place,
+            # they may be hard linked into the workspaces
+            os.chmod(tmp_path, 0o444)
+            os.rename(tmp_path, object_path)
+
+        self.update_entry(url, entry, hit=False)
+        if stream_consumer is None:
+            self.consume(object_path, consumer)
+        return object_path, True
+
+    @staticmethod
+    def consume(object_path, consumer):
+        if consumer is not None:
+            with open(object_path, "rb") as object_file:
+                consumer(object_file)
+
+    def consume_verified(self, url, object_path, consumer, sha256):
+        # a cached object is only read if there is a consumer,
+        # its checksum is verified on the way
+        if consumer is None or sha256 is None:
+            self.consume(object_path, consumer)
+            return
+        checksum = hashlib.sha256()
+        with open(object_path, "rb") as object_file:
+            stream = HashingReader(object_file, checksum)
+            consumer(stream)
+            stream.drain(self.chunk_size)
+        if checksum.hexdigest() != sha256:
+            self.invalidate(url)
+            raise ChecksumError("Cached copy of " + url + " is corrupted: "
+                                "expected " + sha256 + ", got " +
+                                checksum.hexdigest())
+
+    def download(self, url, headers, consumer=None):
+        tmp_dir = self.cache_path + "/tmp"
+        self.utils.mkdir_p(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        header_path = tmp_path + ".headers"
+
+        call = ["curl", "-L", "-sS", "-f", "-D", header_path]
+        for header in headers:
+            call += ["-H", header]
+        call.append(url)
+
+        self.utils.print_message(self.utils.logtype.INFO, "Downloading", url)
+        if self.utils.debug is True:
+            self.utils.print_message(self.utils.logtype.HEADER,
+                                     " ".join(call))
+        sha256 = hashlib.sha256()
+        tmp_file = os.fdopen(fd, "wb")
+        try:
+            try:
+                proc = subprocess.Popen(call, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+            except OSError as exc:
+                raise DownloadError("Downloading " + url + " failed: " +
+                                    str(exc))
+            stream = HashingReader(proc.stdout, sha256, tmp_file)
+            try:
+                if consumer is not None:
+                    consumer(stream)
+                # read what the consumer did not need, e.g. tar padding
+                stream.drain(self.chunk_size)
+            except:
+                if not stream.eof:
+                    proc.kill()
+                proc.wait()
+                # a broken download breaks the consumer too,
+                # report the cause in that case
+                if proc.returncode <= 0:
+                    raise
+            stderr = proc.stderr.read()
+            proc.wait()
+            if proc.returncode != 0:
+                raise DownloadError("Downloading " + url + " failed: " +
+                                    stderr.decode("utf-8", "replace").strip())
+            status, response = self.parse_headers(header_path)
+        except:
+            tmp_file.close()
+            os.remove(tmp_path)
+            raise
+        finally:
+            if os.path.isfile(header_path):
+                os.remove(header_path)
+        tmp_file.close()
+
+        if status == 304:
+            os.remove(tmp_path)
+            tmp_path = None
+        return status, tmp_path, sha256.hexdigest(), response
+
+    @staticmethod
+    def parse_headers(header_path):
+        # with redirects there is a block of headers for every response,
+        # only the last one is interesting
+        status = 0
+        response = dict()
+        with open(header_path, "r") as header_file:
+            for line in header_file:
+                line = line.strip()
+                if line.startswith("HTTP/"):
+                    status = int(line.split()[1])
+                    response = dict()
+                elif ":" in line:
+                    key, value = line.split(":", 1)
+                    response[key.strip().lower()] = value.strip()
+        return status, response
+
+    def update_entry(self, url, entry, hit):
+        with self.index_lock(self):
+            index = self.load_index()
+            entry["last_used"] = time.time()
+            index["entries"][url] = entry
+            if hit:
+                index["hits"] += 1
+            else:
+                index["misses"] += 1
+                self.evict(index, keep=entry["sha256"])
+            self.save_index(index)
+
+    def evict(self, index, keep):
+        # remove the least recently used objects until the cache fits
+        # into its size limit
+        if self.max_size == 0:
+            return
+        objects = dict()
+        for url, entry in index["entries"].items():
+            sha256 = entry["sha256"]
+            last_used, size = objects.get(sha256, (0, entry["size"]))
+            objects[sha256] = (max(last_used, entry["last_used"]), size)
+
+        total_size = sum(size for last_used, size in objects.values())
+        for sha256, (last_used, size) in sorted(objects.items(),
+                                                key=lambda o: o[1][0]):
+            if total_size <= self.max_size:
+                break
+            if sha256 == keep:
+                continue
+            try:
+                os.remove(self.get_object_path(sha256))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+            for url in [u for u, e in index["entries"].items()
+                        if e["sha256"] == sha256]:
+                del index["entries"][url]
+            total_size -= size
+
+    def invalidate(self, url):
+        """Drop the cached copy of url, e.g. when it turned out to be
+        corrupted"""
+        with self.index_lock(self):
+            index = self.load_index()
+            entry = index["entries"].pop(url, None)
+            if entry is None:
+                return
+            if not any(e["sha256"] == entry["sha256"]
+                       for e in index["entries"].values()):
+                object_path = self.get_object_path(entry["sha256"])
+                if os.path.isfile(object_path):
+                    os.remove(object_path)
+            self.save_index(index)
+
+    def verify(self, jobs=1):
+        """Hash all the cached objects, remove the corrupted ones and
+        return the list of their urls"""
+        with self.index_lock(self):
+            index = self.load_index()
+        objects = sorted(set(entry["sha256"]
+                             for entry in index["entries"].values()))
+
+        def check(sha256):
+            object_path = self.get_object_path(sha256)
+            if not os.path.isfile(object_path):
+                return sha256, None
+            checksum = hashlib.sha256()
+            with open(object_path, "rb") as object_file:
+                while True:
+                    data = object_file.read(self.chunk_size)
+                    if not data:
+                        break
+                    checksum.update(data)
+            return sha256, checksum.hexdigest()
+
+        corrupted = []
+        for sha256, checksum in self.utils.run_parallel(check, objects, jobs):
+            if checksum == sha256:
+                continue
+            urls = sorted(url for url, entry in index["entries"].items()
+                          if entry["sha256"] == sha256)
+            if checksum is None:
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Missing cached copy of",
+                                         ", ".join(urls))
+            else:
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "Corrupted cached copy of",
+                                         ", ".join(urls), "- deleting.")
+            # only the broken object goes, the other ones stay cached
+            for url in urls:
+                self.invalidate(url)
+            corrupted.extend(urls)
+        self.utils.print_message(self.utils.logtype.INFO, "Verified",
+                                 len(objects), "cached objects,",
+                                 len(corrupted), "broken")
+        return corrupted
+
+    def place(self, object_path, dst):
+        """Put a cached object at dst, without copying it if possible"""
+        if os.path.exists(dst):
+            if os.path.samefile(object_path, dst):
+                return
+            os.remove(dst)
+        self.utils.link_or_copy(object_path, dst)
+
+    def get_stats(self):
+        with self.index_lock(self):
+            index = self.load_index()
+        sizes = dict()
+        for entry in index["entries"].values():
+            sizes[entry["sha256"]] = entry["size"]
+        stats = dict()
+        stats["path"] = self.cache_path
+        stats["urls"] = len(index["entries"])
+        stats["objects"] = len(sizes)
+        stats["size"] = sum(sizes.values())
+        stats["max_size"] = self.max_size
+        stats["hits"] = index["hits"]
+        stats["misses"] = index["misses"]
+        return stats
+
+    def print_stats(self):
+        stats = self.get_stats()
+        requests = stats["hits"] + stats["misses"]
+        print("Download cache: " + stats["path"])
+        print("URLs:           " + str(stats["urls"]))
+        print("Objects:        " + str(stats["objects"]))
+        print("Size:           " + self.format_size(stats["size"]) +
+              (" of " + self.format_size(stats["max_size"])
+               if stats["max_size"] else " (no limit)"))
+        print("Hits:           " + str(stats["hits"]) +
+              (" ({:.1f}%)".format(100.0 * stats["hits"] / requests)
+               if requests else ""))
+        print("Misses:         " + str(stats["misses"]))
+
+    @staticmethod
+    def format_size(size):
+        for unit in ("B", "KiB", "MiB", "GiB"):
+            if size < 1024:
+                return "{:.1f} {}".format(size, unit)
+            size /= 1024.0
+        return "{:.1f} TiB".format(size)
+
+
+class Prefetch:
+    """Fetch of a single url running in a background thread"""
+
+    def __init__(self, download_cache, url, revalidate, force, sha256,
+                 consumer=None):
+        self.download_cache = download_cache
+        self.url = url
+        self.args = (revalidate, force, consumer,
+                     sha256.strip().lower() if sha256 else None)
+        # the contents are passed to the consumer in the background
+        self.consumed = consumer is not None
+        self.result = None
+        self.error = None
+        self.finished = queue.Queue()
+        # daemon thread, an interrupted run does not wait for it
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = self.download_cache.fetch_object(self.url,
+                                                           *self.args)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.finished.put(None)
+
+    def wait(self):
+        self.download_cache.utils.wait_interruptible(
+            lambda timeout: self.finished.get(True, timeout), queue.Empty)
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -0,0 +1,161 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file ccache.py
+# \brief Enclustra Build Environment compiler cache class
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+import os
+import re
+import stat
+import hashlib
+import tempfile
+import subprocess
+
+# cross compilers found in the toolchains, e.g. arm-linux-gnueabihf-gcc
+COMPILER_PATTERN = re.compile(r"^.+-(gcc|g\+\+|cc|c\+\+|clang|clang\+\+)$")
+
+# --print-stats counters, the names changed with ccache 4
+HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit",
+                "cache_hit_direct", "cache_hit_preprocessed")
+MISS_COUNTERS = ("cache_miss",)
+
+
+class CompilerCache:
+    """
+    ccache shared by all the workspaces of a build host, so rebuilding
+    a clean tree does not compile everything again.
+
+    The compilers of the toolchains are wrapped by scripts calling
+    ccache with the real compiler. The directory of the wrappers is put
+    first on the PATH of the tools, so the build systems use them
+    without any change of their configuration.
+    """
+
+    def __init__(self, ccache_dir, ccache_size, utils):
+        self.ccache_dir = ccache_dir
+        self.ccache_size = ccache_size
+        self.utils = utils
+        self.ccache = utils.find_executable("ccache")
+        self.configured = False
+
+    def is_available(self):
+        return self.ccache is not None
+
+    def get_env(self):
+        env = dict(os.environ)
+        env["CCACHE_DIR"] = self.ccache_dir
+        return env
+
+    def configure(self):
+        # the size limit is kept in the configuration of the cache,
+        # set it once per run
+        if self.configured:
+            return
+        self.configured = True
+        self.utils.mkdir_p(self.ccache_dir)
+        if self.ccache_size is None:
+            return
+        try:
+            subprocess.check_output([self.ccache, "-M", self.ccache_size],
+                                    stderr=subprocess.STDOUT,
+                                    env=self.get_env())
+        except (OSError, subprocess.CalledProcessError) as exc:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Could not set the compiler cache size",
+                                     "to", self.ccache_size + ":", str(exc))
+
+    def get_masquerade_path(self, toolchains_paths):
+        """Return the directory with the ccache wrappers of the compilers
+        in toolchains_paths, None if there is nothing to wrap"""
+        compilers = dict()
+        for path in toolchains_paths:
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                continue
+            for name in names:
+                compiler = os.path.join(path, name)
+                # the first toolchain providing a compiler wins,
+                # like on the PATH
+                if name in compilers or \
+                        not COMPILER_PATTERN.match(name) or \
+                        not os.access(compiler, os.X_OK) or \
+                        os.path.isdir(compiler):
+                    continue
+                compilers[name] = os.path.abspath(compiler)
+        if not compilers:
+            return None
+
+        self.configure()
+        key = "\0".join([self.ccache] + [str(p) for p in toolchains_paths])
+        masquerade_path = self.ccache_dir + "/masquerade/" + \
+            hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+        self.utils.mkdir_p(masquerade_path)
+        for name, compiler in compilers.items():
+            self.write_wrapper(masquerade_path + "/" + name, compiler)
+        return masquerade_path
+
+    def write_wrapper(self, path, compiler):
+        # the real compiler is called by its full path, ccache does not
+        # have to find it on the PATH behind the wrapper
+        quote = self.utils.shell_quote
+        script = "#!/bin/sh\n" + \
+            "CCACHE_DIR=" + quote(self.ccache_dir) + "\n" + \
+            "export CCACHE_DIR\n" + \
+            "exec " + quote(self.ccache) + " " + quote(compiler) + \
+            " \"$@\"\n"
+        try:
+            with open(path, "r") as wrapper:
+                if wrapper.read() == script:
+                    return
+        except IOError:
+            pass
+        # other workspaces may be running the wrapper
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as wrapper:
+            wrapper.write(script)
+        os.chmod(tmp_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP |
+                 stat.S_IROTH | stat.S_IXOTH)
+        os.rename(tmp_path, path)
+
+    def get_stats(self):
+        """Return the hit and miss counters, None if they are not
+        available"""
+        try:
+            output = subprocess.check_output([self.ccache, "--print-stats"],
+                                             stderr=subprocess.STDOUT,
+                                             env=self.get_env())
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        counters = dict()
+        for line in output.decode("utf-8", "replace").splitlines():
+            fields = line.split("\t")
+            if len(fields) == 2 and fields[1].strip().isdigit():
+                counters[fields[0]] = int(fields[1])
+        hits = sum(counters.get(c, 0) for c in HIT_COUNTERS)
+        misses = sum(counters.get(c, 0) for c in MISS_COUNTERS)
+        return hits, misses
+
+    def print_stats(self, start_stats):
+        # the counters are shared with the other users of the cache,
+        # builds running at the same time are counted as well
+        stats = self.get_stats()
+        if stats is None or start_stats is None:
+            # old ccache versions, show their own summary
+            self.utils.call_tool(self.utils.shell_quote(self.ccache) + " -s",
+                                 env=self.get_env())
+            return
+        hits = stats[0] - start_stats[0]
+        misses = stats[1] - start_stats[1]
+        rate = ""
+        if hits + misses:
+            rate = " ({:.0f}% hit rate)".format(100.0 * hits /
+                                                 (hits + misses))
+        self.utils.print_message(self.utils.logtype.INFO, "Compiler cache:",
+                                 str(hits), "hits,", str(misses),
+                                 "misses" + rate)
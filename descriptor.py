@@ -0,0 +1,205 @@
+#! /usr/bin/env python2
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file descriptor.py
+# \brief Enclustra Build Environment target and binary descriptor classes
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+
+class Descriptor(object):
+    """
+    Fields of a target or binary, accessed like a dict with the keys
+    of the ini files, e.g. descriptor["copy_files"].
+
+    The lazy fields are read from the configuration of the owner,
+    the Target object, when they are first accessed. They are not
+    stored in the parse cache, so the cache does not depend on the
+    state of the build trees; the sections they are read from are
+    cached instead.
+    """
+
+    __slots__ = ("owner", "name")
+    # fields set when parsing, in the subclasses
+    FIELDS = ()
+    # fields loaded on first access by the load_<field> methods
+    LAZY = ()
+    # keys whose fields are named differently
+    KEY_FIELDS = {}
+    # suffixes of the sections the lazy fields are read from
+    SECTIONS = ()
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def get_extra(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        field = self.KEY_FIELDS.get(key, key)
+        if field not in self.FIELDS and field not in self.LAZY:
+            return self.get_extra(key)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            if field not in self.LAZY:
+                raise KeyError(key)
+        value = getattr(self, "load_" + field)()
+        setattr(self, field, value)
+        return value
+
+    def __setitem__(self, key, value):
+        field = self.KEY_FIELDS.get(key, key)
+        if field not in self.FIELDS and field not in self.LAZY:
+            raise KeyError(key)
+        setattr(self, field, value)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, items):
+        for key, value in dict(items).items():
+            self[key] = value
+
+    def __getstate__(self):
+        state = {"name": self.name}
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                state[field] = getattr(self, field)
+        return state
+
+    def __setstate__(self, state):
+        # the owner is set again by the Target loading the parse cache
+        self.owner = None
+        for field, value in state.items():
+            setattr(self, field, value)
+
+    def get_section_names(self):
+        return [self.name + suffix for suffix in self.SECTIONS]
+
+    def get_section(self, suffix):
+        return self.owner.get_section(self.name + suffix)
+
+
+class TargetDescriptor(Descriptor):
+    FIELDS = ("help", "helpbox", "disable", "fetch", "disable_fetch",
+              "prefetched", "history", "filter", "partial", "sparse",
+              "sparse_checkout", "build", "active", "disable_build",
+              "build_error", "repository", "priority", "depends", "branch")
+    LAZY = ("configured", "build_commands", "parallelbuild_commands",
+            "patches", "copy_files", "device_tree", "device_tree_path",
+            "scripts")
+    KEY_FIELDS = {"device-tree": "device_tree",
+                  "device-tree-path": "device_tree_path"}
+    SECTIONS = ("-build", "-parallelbuild", "-patches", "-copyfiles",
+                "-device-tree", "-scripts")
+    __slots__ = FIELDS + LAZY
+
+    def get_extra(self, key):
+        # the custom scripts, e.g. prebuild, are keys of the descriptor
+        return self["scripts"][key]
+
+    def load_configured(self):
+        return self.owner.is_target_configured(self.name)
+
+    def load_commands(self, suffix):
+        commands = []
+        for command, cmd in self.get_section(suffix) or []:
+            subtarget = dict()
+            subtarget['name'] = self.name + " " + command
+            subtarget['cmd'] = cmd
+            # do not run defconfig when using saved config
+            # and the target is already configured
+            subtarget['enabled'] = not ("defconfig" in command and
+                                        self.owner.used_previous_config and
+                                        self["configured"])
+            commands.append(subtarget)
+        return commands
+
+    def load_build_commands(self):
+        return self.load_commands("-build")
+
+    def load_parallelbuild_commands(self):
+        return self.load_commands("-parallelbuild")
+
+    def load_patches(self):
+        return [patch for key, patch in self.get_section("-patches") or []]
+
+    def load_copy_files(self):
+        return [[key, path] for key, path in self.get_section("-copyfiles")]
+
+    def load_device_tree(self):
+        return [{'cmd': cmd} for key, cmd in
+                self.get_section("-device-tree") or [] if key != "path"]
+
+    def load_device_tree_path(self):
+        return [{'path': path} for key, path in
+                self.get_section("-device-tree") or [] if key == "path"]
+
+    def load_scripts(self):
+        return dict(self.get_section("-scripts") or [])
+
+
+class BinaryDescriptor(Descriptor):
+    FIELDS = ("default", "description", "helpbox", "uri", "unpack",
+              "redownload", "sha256", "shortname", "chosen", "path")
+    LAZY = ("copy_files", "copy_files_init", "copy_files_default",
+            "device_trees")
+    KEY_FIELDS = {"copy_files-init": "copy_files_init",
+                  "copy_files-default": "copy_files_default"}
+    SECTIONS = ("-copyfiles", "-copyfiles-default")
+    __slots__ = FIELDS + LAZY
+
+    def get_section_names(self):
+        return Descriptor.get_section_names(self) + \
+            [self.name + "-" + target + "-device-tree"
+             for target in self.owner.targets]
+
+    def get_extra(self, key):
+        # the device trees of the targets, e.g. linux-device-tree
+        if not key.endswith("-device-tree"):
+            raise KeyError(key)
+        return self["device_trees"][key[:-len("-device-tree")]]
+
+    def read_copy_files(self):
+        copy_files = self.get_section("-copyfiles")
+        if copy_files is None:
+            return None
+        return [[key, path] for key, path in copy_files]
+
+    def load_copy_files(self):
+        # the files as they were before any changes in the menu
+        if not hasattr(self, "copy_files_init"):
+            self.copy_files_init = self.read_copy_files()
+        return self.read_copy_files()
+
+    def load_copy_files_init(self):
+        return self.read_copy_files()
+
+    def load_copy_files_default(self):
+        # the section is added when parsing if it is missing
+        copy_files = self.get_section("-copyfiles-default")
+        if copy_files is None:
+            return None
+        return [[key, path] for key, path in copy_files]
+
+    def load_device_trees(self):
+        device_trees = dict()
+        for target in self.owner.targets:
+            device_trees[target] = [{'cmd': cmd} for key, cmd in
+                                    self.get_section("-" + target +
+                                                     "-device-tree") or []]
+        return device_trees
@@ -207,7 +207,9 @@ class Gui:
 
     def show_fetch_opts_menu(self, menu_items):
         if len(menu_items) != 0:
-            return self.dialog.checklist("Fetch targets with history?",
+            return self.dialog.checklist("Fetch targets with history,"
+                                         " partial clone or sparse"
+                                         " checkout?",
                                          choices=menu_items,
                                          cancel_label="Back")
         else:
@@ -0,0 +1,111 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file mirror.py
+# \brief Enclustra Build Environment git reference mirrors class
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import threading
+
+
+class ReferenceMirrors:
+    """
+    Bare mirrors of the target repositories shared by all the workspaces
+    of a build host. The submodules are cloned with the mirror as
+    reference, so only the objects missing in the mirror are downloaded.
+
+    Every mirror is updated at most once per run. The update is locked,
+    so several workspaces may use the same mirrors at the same time.
+    """
+
+    def __init__(self, mirrors_path, dissociate, utils):
+        self.mirrors_path = mirrors_path
+        # copy the objects into the workspace instead of keeping
+        # the mirror as an alternate object store
+        self.dissociate = dissociate
+        self.utils = utils
+        self.lock = threading.Lock()
+        # url -> mirror path (None if the update failed) for this run
+        self.updated = dict()
+        self.url_locks = dict()
+
+    def get_mirror_path(self, url):
+        name = os.path.basename(url.rstrip("/"))
+        if name.endswith(".git"):
+            name = name[:-4]
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+        return self.mirrors_path + "/" + name + "-" + url_hash + ".git"
+
+    def get_reference_opts(self, mirror_path):
+        """Return the options for cloning with the mirror as reference,
+        or an empty string if there is no usable mirror"""
+        if mirror_path is None:
+            return ""
+        opts = "--reference " + self.utils.shell_quote(mirror_path)
+        if self.dissociate is True:
+            opts += " --dissociate"
+        return opts
+
+    def update(self, url, target=None):
+        """Update the mirror of url, once per run, and return its path"""
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if url not in self.updated:
+                with self.utils.timing.span("update mirror", target):
+                    self.updated[url] = self.update_mirror(url)
+            return self.updated[url]
+
+    def update_mirror(self, url):
+        mirror_path = self.get_mirror_path(url)
+        try:
+            self.utils.mkdir_p(self.mirrors_path)
+            lock_file = open(mirror_path + ".lock", "a")
+        except (IOError, OSError) as exc:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Could not lock the mirror of", url +
+                                     ":", str(exc))
+            return None
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isdir(mirror_path):
+                self.utils.print_message(self.utils.logtype.INFO,
+                                         "Updating the mirror of", url)
+                call = "git fetch --prune --quiet"
+                sp = self.utils.call_tool(call, cwd=mirror_path)
+            else:
+                self.utils.print_message(self.utils.logtype.INFO,
+                                         "Creating a mirror of", url)
+                # clone next to the final path, an interrupted clone
+                # must not look like a mirror
+                tmp_path = mirror_path + ".tmp"
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+                call = "git clone --mirror --quiet " + \
+                    self.utils.shell_quote(url) + " " + \
+                    self.utils.shell_quote(tmp_path)
+                sp = self.utils.call_tool(call)
+                if sp == 0:
+                    os.rename(tmp_path, mirror_path)
+                elif os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+        finally:
+            lock_file.close()
+
+        if sp != 0:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Updating the mirror of", url,
+                                     "failed - fetching without it")
+            return None
+        return mirror_path
@@ -15,20 +15,36 @@ import configparser
 import os
 import sys
 import stat
-import shutil
 import archive
+import cache
 import copy
-import tempfile
+import json
+import hashlib
 import subprocess
+import threading
+import descriptor
 from utils import Utils
+from descriptor import TargetDescriptor, BinaryDescriptor
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 
 class Target:
     def __init__(self, root_path, master_repo_path, config_path, ini_files,
                  target_name, debug_calls, utils, history_path, release,
-                 used_previous_config):
-        self.config = configparser.ConfigParser()
-        self.config.optionxform = str
+                 used_previous_config, parse_cache=None):
+        self.ini_files = ini_files
+        # sections read by the descriptors, until the config is read
+        self.sections = None
         self.used_previous_config = used_previous_config
         self.root_path = root_path
         self.master_repo_path = master_repo_path
@@ -44,11 +60,22 @@ class Target:
         self.history_path = history_path
         self.utils = utils
         self.out_dir = None
+        self.tool_envs = dict()
+        # fingerprints of the last builds of the targets in this run
+        self.target_fingerprints = dict()
+        self.fingerprint_lock = threading.Lock()
+        # remote refs listed in this run, see get_remote_refs
+        self.remote_refs = dict()
+        # targets which were already at the tip of their branch
+        self.up_to_date_targets = set()
 
         try:
             self.config_path = config_path
-            self.config.read(ini_files)
-            self.parse_init_file()
+            cache_path = self.get_parse_cache_path(parse_cache, ini_files)
+            if not self.load_parse_cache(cache_path):
+                self.config = self.read_config()
+                self.parse_init_file()
+                self.save_parse_cache(cache_path)
         except configparser.ParsingError as e:
             subprocess.call("clear")
             err_msg = str(e).replace("\n", " ")
@@ -62,6 +89,33 @@ class Target:
             # This is a serious error, exit even if exit on error is not set
             sys.exit(1)
 
+    def __getattr__(self, name):
+        # the ini files of cached targets are read on first use
+        # of the config, see load_parse_cache
+        if name != "config" or self.__dict__.get("sections") is None:
+            raise AttributeError(name)
+        self.config = self.read_config()
+        for binary in self.binaries:
+            self.add_default_copyfiles(binary)
+        self.sections = None
+        return self.config
+
+    def read_config(self):
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read(self.ini_files)
+        return config
+
+    def get_section(self, section):
+        # the items of a section as read from the config,
+        # None if there is no such section
+        if "config" not in self.__dict__ and self.sections is not None:
+            return self.sections.get(section)
+        if not self.config.has_section(section):
+            return None
+        return [(key, self.config[section][key])
+                for key in self.config[section]]
+
     def save_config(self, filename):
         for t in self.targets:
             key = t + "-options"
@@ -71,6 +125,12 @@ class Target:
             self.config.set(key, "fetch", str(self.targets[t]["fetch"]))
             self.config.set(key, "fetch_history",
                             str(self.targets[t]["history"]))
+            if self.targets[t]["filter"] is not None:
+                self.config.set(key, "fetch_partial",
+                                str(self.targets[t]["partial"]))
+            if self.targets[t]["sparse"]:
+                self.config.set(key, "fetch_sparse",
+                                str(self.targets[t]["sparse_checkout"]))
 
             self.config.set(key, "build", str(self.targets[t]["build"]))
 
@@ -275,34 +335,134 @@ class Target:
     def get_name(self):
         return self.target_name
 
+    def get_parse_cache_path(self, parse_cache, ini_files):
+        # the parsed descriptors depend on the ini files
+        # and on the code parsing them
+        if parse_cache is None:
+            return None
+        if not isinstance(ini_files, (list, tuple)):
+            ini_files = [ini_files]
+        # nothing depending on the build trees may be stored, e.g. the
+        # defconfig steps of saved configurations are enabled only for
+        # targets which are not configured yet, see descriptor.py
+        key = [sys.version_info[0], self.release, self.used_previous_config]
+        code = [os.path.splitext(f)[0] + ".py"
+                for f in (__file__, descriptor.__file__)]
+        for path in list(ini_files) + code:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+                key.append([path, st.st_mtime, st.st_size])
+            except OSError:
+                key.append([path, None, None])
+        sha = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return parse_cache + "/" + sha + ".pickle"
+
+    def load_parse_cache(self, cache_path):
+        if cache_path is None or not os.path.isfile(cache_path):
+            return False
+        try:
+            with open(cache_path, "rb") as f:
+                parsed = pickle.load(f)
+        except Exception:
+            # parse the ini files again if the cache is broken
+            return False
+        # the config is not rebuilt, the descriptors only need
+        # a few of its sections
+        self.sections = parsed["sections"]
+        self.toolchains = parsed["toolchains"]
+        self.targets = parsed["targets"]
+        self.binaries = parsed["binaries"]
+        for d in list(self.targets.values()) + list(self.binaries.values()):
+            d.owner = self
+        self.const_files = parsed["const_files"]
+        self.bootimages = parsed["bootimages"]
+        self.clean = parsed["clean"]
+        # mark as recently used, the oldest entries are removed
+        os.utime(cache_path, None)
+        return True
+
+    def save_parse_cache(self, cache_path):
+        if cache_path is None:
+            return
+        sections = dict()
+        for d in list(self.targets.values()) + list(self.binaries.values()):
+            for section in d.get_section_names():
+                items = self.get_section(section)
+                if items is not None:
+                    sections[section] = items
+        parsed = dict()
+        parsed["sections"] = sections
+        parsed["toolchains"] = self.toolchains
+        parsed["targets"] = self.targets
+        parsed["binaries"] = self.binaries
+        parsed["const_files"] = self.const_files
+        parsed["bootimages"] = self.bootimages
+        parsed["clean"] = self.clean
+        try:
+            self.utils.mkdir_p(os.path.dirname(cache_path))
+            tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(parsed, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+            self.prune_parse_cache(os.path.dirname(cache_path))
+        except Exception as exc:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Error while saving parsed targets:",
+                                     str(exc))
+
+    def prune_parse_cache(self, parse_cache, keep=256):
+        entries = [parse_cache + "/" + f for f in os.listdir(parse_cache)
+                   if f.endswith(".pickle")]
+        if len(entries) <= keep:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:-keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
     def parse_init_file(self):
         for toolchain in self.config['toolchains']:
             self.toolchains.append(self.config['toolchains'][toolchain])
         # get targets
         for target in self.config['targets']:
-            target_descriptor = dict()
-            target_build_commands = []
-            target_patches = []
-            target_parallelbuild_commands = []
-            target_copyfiles = []
+            # the build commands, device trees, patches, copyfiles
+            # and scripts are read on first access, see descriptor.py
+            target_descriptor = TargetDescriptor(self, target)
             target_help = str(target)
             target_helpbox = None
             target_disable = None
             target_branch = None
             target_fetch = False
             target_fetch_history = False
+            target_filter = None
+            target_partial = True
+            target_sparse = []
+            target_sparse_checkout = True
             target_build = False
             target_active = self.config.getboolean('targets', target)
             target_repository = self.config[target]['repository']
             target_prefetched = False
-            target_dt = []
-            target_dt_path = []
+
+            # every target has to copy its results
+            if not self.config.has_section(target + "-copyfiles"):
+                raise KeyError(target + "-copyfiles")
 
             try:
                 target_priority = int(self.config[target]['priority'])
             except:
                 target_priority = 50
 
+            # targets which have to be built before this one,
+            # None means that the priority decides
+            target_depends = None
+            if self.config.has_option(target, "depends") is True:
+                target_depends = [d.strip() for d in
+                                  self.config[target]["depends"].split(",")
+                                  if d.strip()]
+
             if self.config.has_option(target, "branch") is True:
                 target_branch = self.config[target]["branch"]
             else:
@@ -320,56 +480,6 @@ class Target:
 
             key = target + "-options"
 
-            # check if target is configured
-            # this is needed in next step
-            target_configured = os.path.isfile(
-                                    os.path.join(self.master_repo_path,
-                                                 target_repository,
-                                                 ".config"))
-
-            if self.config.has_section(target + "-device-tree") is True:
-                for command in self.config[target + "-device-tree"]:
-                    subtarget = dict()
-                    if command == "path":
-                        subtarget['path'] = self.config[str(target) +
-                                                   "-device-tree"][command]
-                        target_dt_path.append(subtarget)
-                    else:
-                        subtarget['cmd'] = self.config[str(target) +
-                                                   "-device-tree"][command]
-                        target_dt.append(subtarget)
-	    
-            if self.config.has_section(target + "-build") is True:
-                for command in self.config[target + "-build"]:
-                    subtarget = dict()
-                    subtarget['name'] = target + " " + command
-                    subtarget['cmd'] = self.config[str(target) +
-                                                   "-build"][command]
-
-                    subtarget['enabled'] = True
-                    # do not run defconfig when using saved config
-                    # and the target is already configured
-                    if ("defconfig" in command and
-                            self.used_previous_config and target_configured):
-                        subtarget['enabled'] = False
-
-                    target_build_commands.append(subtarget)
-
-            if self.config.has_section(target + "-parallelbuild") is True:
-                for command in self.config[target + "-parallelbuild"]:
-                    subtarget = dict()
-                    subtarget['name'] = target + " " + command
-                    subtarget['cmd'] = self.config[str(target) +
-                                                   "-parallelbuild"][command]
-                    subtarget['enabled'] = True
-                    # do not run defconfig when using saved config
-                    # and the target is already configured
-                    if ("defconfig" in command and
-                            self.used_previous_config and target_configured):
-                        subtarget['enabled'] = False
-
-                    target_parallelbuild_commands.append(subtarget)
-
             if self.config.has_section(key) is True:
                 if self.config.has_option(key, "fetch"):
                     target_fetch = self.config.getboolean(key, "fetch")
@@ -382,44 +492,38 @@ class Target:
                 if self.config.has_option(key, "prefetched"):
                     target_prefetched = self.config.getboolean(key, "prefetched")
 
-
-            if self.config.has_section(target + "-patches") is True:
-                for patch in self.config[target + "-patches"]:
-                    target_patches.append(self.config[str(target) +
-                                          "-patches"][patch])
-
-            for copyfile in self.config[target + "-copyfiles"]:
-                target_copyfiles.append([copyfile, self.config[str(target) +
-                                        "-copyfiles"][copyfile]])
-
-            # check if there are some scripts to run
-            if str(target + "-scripts") in self.config:
-                for script in self.config[target + "-scripts"]:
-                    target_descriptor.update([(script, self.config[target +
-                                             "-scripts"][script])])
-
-            target_descriptor.update([("help", target_help)])
-            target_descriptor.update([("helpbox", target_helpbox)])
-            target_descriptor.update([("disable", target_disable)])
-            target_descriptor.update([("fetch", target_fetch)])
-            target_descriptor.update([("disable_fetch", False)])
-            target_descriptor.update([("prefetched", target_prefetched)])
-            target_descriptor.update([("history", target_fetch_history)])
-            target_descriptor.update([("build", target_build)])
-            target_descriptor.update([("active", target_active)])
-            target_descriptor.update([("disable_build", False)])
-            target_descriptor.update([("build_error", False)])
-            target_descriptor.update([("repository", target_repository)])
-            target_descriptor.update([("priority", target_priority)])
-            target_descriptor.update([("branch", target_branch)])
-            target_descriptor.update([("patches", target_patches)])
-            target_descriptor.update([("build_commands",
-                                     target_build_commands)])
-            target_descriptor.update([("parallelbuild_commands",
-                                     target_parallelbuild_commands)])
-            target_descriptor.update([("copy_files", target_copyfiles)])
-            target_descriptor.update([("device-tree", target_dt)])
-            target_descriptor.update([("device-tree-path", target_dt_path)])
+                # partial clone filter, e.g. blob:none
+                if self.config.has_option(key, "filter"):
+                    target_filter = self.config[key]["filter"].strip() or None
+                if self.config.has_option(key, "fetch_partial"):
+                    target_partial = self.config.getboolean(key,
+                                                            "fetch_partial")
+                # space separated directories of a cone mode sparse checkout
+                if self.config.has_option(key, "sparse"):
+                    target_sparse = self.config[key]["sparse"].split()
+                if self.config.has_option(key, "fetch_sparse"):
+                    target_sparse_checkout = \
+                        self.config.getboolean(key, "fetch_sparse")
+
+            target_descriptor.help = target_help
+            target_descriptor.helpbox = target_helpbox
+            target_descriptor.disable = target_disable
+            target_descriptor.fetch = target_fetch
+            target_descriptor.disable_fetch = False
+            target_descriptor.prefetched = target_prefetched
+            target_descriptor.history = target_fetch_history
+            target_descriptor.filter = target_filter
+            target_descriptor.partial = target_partial
+            target_descriptor.sparse = target_sparse
+            target_descriptor.sparse_checkout = target_sparse_checkout
+            target_descriptor.build = target_build
+            target_descriptor.active = target_active
+            target_descriptor.disable_build = False
+            target_descriptor.build_error = False
+            target_descriptor.repository = target_repository
+            target_descriptor.priority = target_priority
+            target_descriptor.depends = target_depends
+            target_descriptor.branch = target_branch
 
             self.targets.update([(target, target_descriptor)])
 
@@ -430,10 +534,9 @@ class Target:
         # get binaries (if any)
         if self.config.has_section("binaries"):
             for binary in self.config["binaries"]:
-                binary_descriptor = dict()
-                binary_copyfiles = []
-                binary_copyfiles_init = []
-                binary_copyfiles_def = []
+                # the copyfiles and device trees are read
+                # on first access, see descriptor.py
+                binary_descriptor = BinaryDescriptor(self, binary)
 
                 is_default = self.config.getboolean("binaries", binary)
                 download_uri = self.config[binary]["url"]
@@ -447,6 +550,11 @@ class Target:
                 else:
                     redownload = False
                 unpack = self.config.getboolean(binary, "unpack")
+                # optional checksum of the downloaded file
+                if self.config.has_option(binary, "sha256"):
+                    sha256 = self.config[binary]["sha256"]
+                else:
+                    sha256 = None
                 description = self.config[binary]["description"]
                 if self.config.has_option(binary, "chosen"):
                     chosen = self.config[binary]["chosen"]
@@ -457,59 +565,17 @@ class Target:
                 else:
                     helpbox = None
 
-                if self.config.has_section(binary+"-copyfiles"):
-                    for copyfile in self.config[binary+"-copyfiles"]:
-                        binary_copyfiles.append([copyfile,
-                                                 self.config[
-                                                    binary + "-copyfiles"]
-                                                 [copyfile]])
-                    binary_copyfiles_init = copy.deepcopy(binary_copyfiles)
-                else:
-                    binary_copyfiles = None
-                    binary_copyfiles_init = None
-
-                if self.config.has_section(binary+"-copyfiles-default"):
-                    for copyf_def in self.config[binary+"-copyfiles-default"]:
-                        binary_copyfiles_def.append([copyf_def,
-                                                    self.config[binary +
-                                                     "-copyfiles-default"]
-                                                     [copyf_def]])
-                else:
-                    # no default section for copyfiles
-                    # set current copyfiles to be default
-                    # and update config section
-                    binary_copyfiles_def = copy.deepcopy(binary_copyfiles)
-                    if binary_copyfiles is not None:
-                        self.config.add_section(binary+"-copyfiles-default")
-                        for copyfile in self.config[binary+"-copyfiles"]:
-                            self.config.set(binary+"-copyfiles-default",
-                                            copyfile,
-                                            self.config[binary + "-copyfiles"]
-                                            [copyfile])
-
-                # get device-tree for each target individually
-                for target in self.config['targets']:
-                    binary_dt = []
-                    if self.config.has_section(binary + "-" + target + "-device-tree"):
-                        for dt in self.config[binary + "-" + target + "-device-tree"]:
-                            subtarget = dict()
-                            subtarget['cmd'] = self.config[binary + "-" + target + "-device-tree"][dt]
-                            binary_dt.append(subtarget)
-                    binary_descriptor.update([(target + "-device-tree", binary_dt)])
-
-                binary_descriptor.update([("default", is_default)])
-                binary_descriptor.update([("description", description)])
-                binary_descriptor.update([("helpbox", helpbox)])
-                binary_descriptor.update([("uri", download_uri)])
-                binary_descriptor.update([("unpack", unpack)])
-                binary_descriptor.update([("redownload", redownload)])
-                binary_descriptor.update([("shortname", shortname)])
-                binary_descriptor.update([("copy_files", binary_copyfiles)])
-                binary_descriptor.update([("copy_files-init",
-                                         binary_copyfiles_init)])
-                binary_descriptor.update([("copy_files-default",
-                                         binary_copyfiles_def)])
-                binary_descriptor.update([("chosen", bool(chosen))])
+                self.add_default_copyfiles(binary)
+
+                binary_descriptor.default = is_default
+                binary_descriptor.description = description
+                binary_descriptor.helpbox = helpbox
+                binary_descriptor.uri = download_uri
+                binary_descriptor.unpack = unpack
+                binary_descriptor.redownload = redownload
+                binary_descriptor.sha256 = sha256
+                binary_descriptor.shortname = shortname
+                binary_descriptor.chosen = bool(chosen)
 
                 self.binaries.update([(binary, binary_descriptor)])
 
@@ -538,6 +604,19 @@ class Target:
                 self.bootimages[k]['files'] = files
                 self.bootimages[k]['result_files'] = result_files
 
+    def add_default_copyfiles(self, binary):
+        if not self.config.has_section(binary+"-copyfiles-default") \
+                and self.config.has_section(binary+"-copyfiles"):
+            # no default section for copyfiles
+            # set current copyfiles to be default
+            # and update config section
+            self.config.add_section(binary+"-copyfiles-default")
+            for copyfile in self.config[binary+"-copyfiles"]:
+                self.config.set(binary+"-copyfiles-default",
+                                copyfile,
+                                self.config[binary + "-copyfiles"]
+                                [copyfile])
+
     def clean_targets(self, targets):
         for t in targets:
             if t not in self.clean:
@@ -550,10 +629,14 @@ class Target:
                                      "Running clean command for",
                                      t, "target")
 
-            with self.utils.cd((self.master_repo_path + "/" +
-                               (self.targets[t])["repository"])):
-                # build parallel targets
-                self.utils.call_tool(self.clean[t])
+            repo_dir = self.master_repo_path + "/" + \
+                (self.targets[t])["repository"]
+            # the build tree is not up to date anymore
+            fingerprints_path = self.get_fingerprints_path(t)
+            if fingerprints_path and os.path.isfile(fingerprints_path):
+                os.remove(fingerprints_path)
+            self.utils.call_tool(self.clean[t], cwd=repo_dir,
+                                 templates=self.get_build_templates(t))
 
     def get_target_helpbox(self, target):
         try:
@@ -657,14 +740,31 @@ class Target:
         for target in self.targets:
             # if file is marked to fetch we return its opts
             if (self.targets[target])["fetch"] is True:
-                fetch_opts.append([target, "",
+                fetch_opts.append([target, "history",
                                   (self.targets[target])["history"]])
+                if (self.targets[target])["filter"] is not None:
+                    fetch_opts.append([target + ":partial", "filter=" +
+                                      (self.targets[target])["filter"],
+                                      (self.targets[target])["partial"]])
+                if (self.targets[target])["sparse"]:
+                    fetch_opts.append([target + ":sparse", " ".join(
+                                      (self.targets[target])["sparse"]),
+                                      (self.targets[target])["sparse_checkout"]])
         return fetch_opts
 
     def set_fetch_opts(self, fetch_opts):
         for target in self.targets:
             (self.targets[target])["history"] = target in fetch_opts
 
+    def set_fetch_modes(self, fetch_opts):
+        # the partial clone and sparse checkout entries of the fetch
+        # options menu
+        for target in self.targets:
+            (self.targets[target])["partial"] = \
+                target + ":partial" in fetch_opts
+            (self.targets[target])["sparse_checkout"] = \
+                target + ":sparse" in fetch_opts
+
     def get_build_opts(self, option):
         build_opts = []
 
@@ -852,11 +952,45 @@ class Target:
         return all_custom
 
     def is_target_configured(self, target):
-        return os.path.isfile(os.path.join(self.master_repo_path,
-                              self.targets[target]["repository"],
-                              ".config"))
+        return os.path.isfile(os.path.join(self.get_tree_dir(target),
+                                           ".config"))
+
+    def is_build_dir_used(self, target):
+        # targets whose build commands use the {ebe_builddir} template
+        # are built out of tree, in a directory of the device
+        for section in (target + "-build", target + "-parallelbuild"):
+            if any("{ebe_builddir}" in cmd
+                   for command, cmd in self.get_section(section) or []):
+                return True
+        return False
 
-    def do_fetch(self, git_use_depth, git_use_remote):
+    def get_build_dir_path(self, repository):
+        # saved configurations keep the name of their device
+        name = self.target_name
+        if self.config.has_option("project", "name"):
+            name = self.config["project"]["name"]
+        return self.root_path + "/build_" + name + "/" + repository
+
+    def get_build_dir(self, target):
+        # out-of-tree build directory, None for targets built in place
+        if not self.is_build_dir_used(target):
+            return None
+        return self.get_build_dir_path((self.targets[target])["repository"])
+
+    def get_tree_dir(self, target):
+        # directory with the results of the build of the target
+        build_dir = self.get_build_dir(target)
+        if build_dir is not None:
+            return build_dir
+        return self.master_repo_path + "/" + \
+            str((self.targets[target])["repository"])
+
+    def get_build_templates(self, target):
+        return {"ebe_builddir": self.get_build_dir_path(
+                (self.targets[target])["repository"])}
+
+    def do_fetch(self, git_use_depth, git_use_remote, fetch_jobs=1,
+                 reference_mirrors=None):
         if git_use_depth is False:
             self.utils.print_message(self.utils.logtype.WARNING,
                                      "Your version of git does not support"
@@ -864,6 +998,7 @@ class Target:
                                      " repositories will be fetched with a"
                                      " history - this may take a long time."
                                      "Consider upgrading your git version.")
+        fetch_targets = []
         for target in sorted(self.targets,
                              key=lambda t: self.targets[t]["priority"]):
             if (self.targets[target])["fetch"] is False:
@@ -872,78 +1007,336 @@ class Target:
                 continue
             if (self.targets[target])["prefetched"] is True:
                 continue
+            fetch_targets.append(target)
 
-            self.utils.print_message(self.utils.logtype.INFO, "Fetching",
-                                     target)
-            # If target is set to fetch w/o history or we have old git version
-            if (self.targets[target])["history"] is False\
-               and git_use_depth is True:
-                depth = "--depth 1"
-            else:
-                depth = ""
-
-            call = "git submodule init " + (self.targets[target])["repository"]
-            with self.utils.cd(self.master_repo_path):
-                sp = self.utils.call_tool(call)
-            if sp != 0:
-                self.utils.print_message(self.utils.logtype.WARNING,
-                                         "Repository initialization for",
-                                         target, "failed")
+        # checkouts already at the tip of their branch are left alone
+        up_to_date = self.get_up_to_date_targets(fetch_targets, fetch_jobs)
+        for target in fetch_targets:
+            if target not in up_to_date:
                 continue
-            if git_use_remote is True:
-                remote = "--remote"
-            else:
-                remote = ""
-            call = "git submodule update " + remote + " " + depth + " " +\
-                   (self.targets[target])["repository"]
-            with self.utils.cd(self.master_repo_path):
-                sp = self.utils.call_tool(call)
-            if sp != 0:
+            self.utils.print_message(self.utils.logtype.OK, "Target",
+                                     target, "up to date")
+            if self.update_sparse_checkout(target) != 0:
                 self.utils.print_message(self.utils.logtype.WARNING,
-                                         "Fetching for", target, "failed")
-                continue
+                                         "Sparse checkout for", target,
+                                         "failed")
+        self.up_to_date_targets.update(up_to_date)
+        fetch_targets = [t for t in fetch_targets if t not in up_to_date]
 
-            # Switch branch if specified
-            if (self.targets[target])["branch"] is not None:
-                call = "git fetch " + depth + " origin " + \
-                       (self.targets[target])["branch"]
-
-                repo_dir = \
-                    self.master_repo_path + "/" + \
-                    str((self.targets[target])["repository"])
-
-                with self.utils.cd(repo_dir):
-                    sp = self.utils.call_tool(call)
-                call = "git checkout FETCH_HEAD"
-                if sp == 0:
-                    with self.utils.cd(repo_dir):
-                        sp = self.utils.call_tool(call)
-            if sp != 0:
+        if fetch_jobs > 1 and len(fetch_targets) > 1:
+            self.utils.print_message(self.utils.logtype.INFO, "Fetching",
+                                     ", ".join(fetch_targets), "using",
+                                     min(fetch_jobs, len(fetch_targets)),
+                                     "jobs")
+
+        # registering a submodule modifies the superproject config,
+        # so only one target at a time may do it
+        submodule_init_lock = threading.Lock()
+
+        def fetch_job(target):
+            # keep the output of every target in a separate block
+            if fetch_jobs > 1:
+                self.utils.start_output_capture()
+            try:
+                with self.utils.timing.span("fetch", target):
+                    self.fetch_target(target, git_use_depth, git_use_remote,
+                                      submodule_init_lock, reference_mirrors)
+            except SystemExit as exc:
+                # raised by break on error, re-raise it in the main thread
+                return self.utils.stop_output_capture(), exc
+            return self.utils.stop_output_capture(), None
+
+        # the results come in the priority order
+        for captured, exc in self.utils.run_parallel(fetch_job, fetch_targets,
+                                                     fetch_jobs):
+            self.utils.flush_captured_output(captured)
+            if exc is not None:
+                raise exc
+
+    def fetch_target(self, target, git_use_depth, git_use_remote,
+                     submodule_init_lock, reference_mirrors=None):
+        self.utils.print_message(self.utils.logtype.INFO, "Fetching",
+                                 target)
+        # If target is set to fetch w/o history or we have old git version
+        if (self.targets[target])["history"] is False\
+           and git_use_depth is True:
+            depth = "--depth 1"
+        else:
+            depth = ""
+
+        call = "git submodule init " + (self.targets[target])["repository"]
+        with submodule_init_lock:
+            sp = self.utils.call_tool(call, cwd=self.master_repo_path)
+        if sp != 0:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Repository initialization for",
+                                     target, "failed")
+            return False
+        if git_use_remote is True:
+            remote = "--remote"
+        else:
+            remote = ""
+
+        repository = (self.targets[target])["repository"]
+        partial = self.get_fetch_filter(target) is not None or \
+            len(self.get_sparse_dirs(target)) > 0
+        url = None
+        if reference_mirrors is not None or partial:
+            url = self.get_submodule_url(repository)
+
+        # take the objects from the local mirror if there is one
+        reference = ""
+        mirror_path = None
+        if reference_mirrors is not None and url is not None:
+            mirror_path = reference_mirrors.update(url, target)
+            reference = reference_mirrors.get_reference_opts(mirror_path)
+
+        if partial and url is not None and \
+                not self.is_submodule_cloned(repository):
+            if not self.clone_submodule(target, url, depth, reference):
                 self.utils.print_message(self.utils.logtype.WARNING,
                                          "Fetching for", target, "failed")
+                return False
+        elif self.is_submodule_cloned(repository):
+            # apply the patterns before checking out the new commit
+            if self.update_sparse_checkout(target) != 0:
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Sparse checkout for", target,
+                                         "failed")
+
+        call = "git submodule update " + remote + " " + depth + " " +\
+               reference + " " + repository
+        sp = self.utils.call_tool(call, cwd=self.master_repo_path)
+        if sp != 0:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Fetching for", target, "failed")
+            return False
+
+        # Switch branch if specified
+        if (self.targets[target])["branch"] is not None:
+            # the mirror was updated in this run, fetch the branch from it
+            source = "origin"
+            if mirror_path is not None:
+                source = self.utils.shell_quote(mirror_path)
+            call = "git fetch " + depth + " " + source + " " + \
+                   (self.targets[target])["branch"]
+
+            repo_dir = \
+                self.master_repo_path + "/" + \
+                str((self.targets[target])["repository"])
+
+            sp = self.utils.call_tool(call, cwd=repo_dir)
+            call = "git checkout FETCH_HEAD"
+            if sp == 0:
+                sp = self.utils.call_tool(call, cwd=repo_dir)
+        if sp != 0:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Fetching for", target, "failed")
+            return False
+
+        self.utils.print_message(self.utils.logtype.OK, "Target",
+                                 target, "fetched")
+
+        # if there is postfetch custom script
+        if "postfetch" in self.targets[target]:
+            try:
+                self.utils.run_script("postfetch", self.targets[target],
+                                      self.config_path,
+                                      self.master_repo_path)
+            except:
+                (self.targets[target])["build"] = False
+        return True
+
+    def get_up_to_date_targets(self, targets, jobs=1):
+        # compare the checked out commits of the targets with the tips
+        # of their branches, listing every remote only once
+        checkouts = dict()
+        for target in targets:
+            branch = (self.targets[target])["branch"]
+            if branch is None:
+                continue
+            repository = (self.targets[target])["repository"]
+            repo_dir = self.master_repo_path + "/" + str(repository)
+            if not os.path.exists(repo_dir + "/.git"):
+                continue
+            try:
+                head = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                               cwd=repo_dir)
+            except (subprocess.CalledProcessError, OSError):
                 continue
+            url = self.get_submodule_url(repository)
+            if url is not None:
+                checkouts[target] = (url, branch,
+                                     head.decode("utf-8").strip())
+
+        branches = dict()
+        for url, branch, head in checkouts.values():
+            branches.setdefault(url, set()).add(branch)
+        urls = [url for url in sorted(branches)
+                if url not in self.remote_refs]
+        for url, refs in zip(urls, self.utils.run_parallel(
+                lambda url: self.get_remote_refs(url, branches[url]),
+                urls, jobs)):
+            self.remote_refs[url] = refs
+
+        up_to_date = []
+        for target, (url, branch, head) in checkouts.items():
+            refs = self.remote_refs.get(url)
+            if refs is None:
+                continue
+            if branch == head:
+                # the branch is a commit id
+                up_to_date.append(target)
+                continue
+            # the order in which git fetch resolves the name
+            for ref in (branch, "refs/" + branch, "refs/tags/" + branch,
+                        "refs/heads/" + branch):
+                sha = refs.get(ref + "^{}", refs.get(ref))
+                if sha is not None:
+                    if sha == head:
+                        up_to_date.append(target)
+                    break
+        return up_to_date
+
+    def get_remote_refs(self, url, branches):
+        # the patterns match the end of the ref names, so the peeled
+        # annotated tags are listed too
+        call = ["git", "ls-remote", url] + sorted(branches)
+        if self.utils.debug is True:
+            self.utils.print_message(self.utils.logtype.HEADER,
+                                     " ".join(call))
+        try:
+            output = subprocess.check_output(call, cwd=self.master_repo_path)
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        refs = dict()
+        for line in output.decode("utf-8").splitlines():
+            sha, ref = line.split("\t", 1)
+            refs[ref] = sha
+        return refs
+
+    def get_submodule_name(self, repository):
+        try:
+            paths = subprocess.check_output(
+                ["git", "config", "-f", ".gitmodules", "--get-regexp",
+                 r"^submodule\..*\.path$"], cwd=self.master_repo_path)
+            for line in paths.decode("utf-8").splitlines():
+                key, path = line.split(" ", 1)
+                if path.strip("/") == repository.strip("/"):
+                    return key[len("submodule."):-len(".path")]
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            pass
+        return None
 
-            self.utils.print_message(self.utils.logtype.OK, "Target",
-                                     target, "fetched")
+    def get_submodule_url(self, repository):
+        # the url registered by "git submodule init", relative urls
+        # of .gitmodules are already resolved there
+        name = self.get_submodule_name(repository)
+        if name is None:
+            return None
+        try:
+            url = subprocess.check_output(
+                ["git", "config", "--get", "submodule." + name + ".url"],
+                cwd=self.master_repo_path)
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        return url.decode("utf-8").strip()
+
+    def is_submodule_cloned(self, repository):
+        # a deinitialized submodule keeps its git dir in the superproject
+        if os.path.exists(os.path.join(self.master_repo_path, repository,
+                                       ".git")):
+            return True
+        name = self.get_submodule_name(repository)
+        if name is None:
+            return True
+        try:
+            git_dir = subprocess.check_output(
+                ["git", "rev-parse", "--git-path", "modules/" + name],
+                cwd=self.master_repo_path)
+        except (subprocess.CalledProcessError, OSError):
+            return True
+        return os.path.isdir(os.path.join(self.master_repo_path,
+                                          git_dir.decode("utf-8").strip()))
+
+    def get_fetch_filter(self, target):
+        if (self.targets[target])["partial"] is True:
+            return (self.targets[target])["filter"]
+        return None
 
-            # if there is postfetch custom script
-            if "postfetch" in self.targets[target]:
-                try:
-                    self.utils.run_script("postfetch", self.targets[target],
-                                          self.config_path,
-                                          self.master_repo_path)
-                except:
-                    (self.targets[target])["build"] = False
+    def get_sparse_dirs(self, target):
+        if (self.targets[target])["sparse_checkout"] is True:
+            return (self.targets[target])["sparse"]
+        return []
+
+    def clone_submodule(self, target, url, depth, reference):
+        # "git submodule update" would check out the whole tree, so the
+        # first clone of a partial or sparse target is done here and
+        # moved into the superproject afterwards
+        repository = (self.targets[target])["repository"]
+        repo_dir = self.master_repo_path + "/" + str(repository)
+        fetch_filter = self.get_fetch_filter(target)
+        sparse_dirs = self.get_sparse_dirs(target)
+        quote = self.utils.shell_quote
+
+        call = "git clone --no-checkout " + depth + " " + reference
+        if fetch_filter is not None:
+            call += " --filter=" + quote(fetch_filter)
+        call += " " + quote(url) + " " + quote(repository)
+        calls = [(call, self.master_repo_path)]
+        if sparse_dirs:
+            calls.append(("git sparse-checkout set --cone " +
+                          " ".join(quote(d) for d in sparse_dirs), repo_dir))
+        calls.append(("git read-tree -mu HEAD", repo_dir))
+        calls.append(("git submodule absorbgitdirs " + quote(repository),
+                      self.master_repo_path))
+        for call, cwd in calls:
+            if self.utils.call_tool(call, cwd=cwd) != 0:
+                return False
+        return True
+
+    def update_sparse_checkout(self, target):
+        repo_dir = self.master_repo_path + "/" + \
+            str((self.targets[target])["repository"])
+        sparse_dirs = self.get_sparse_dirs(target)
+        if sparse_dirs:
+            call = "git sparse-checkout set --cone " + \
+                " ".join(self.utils.shell_quote(d) for d in sparse_dirs)
+            return self.utils.call_tool(call, cwd=repo_dir)
+        # bring back the whole tree if sparse checkout was switched off
+        try:
+            enabled = subprocess.check_output(
+                ["git", "config", "--bool", "--get", "core.sparseCheckout"],
+                cwd=repo_dir)
+        except (subprocess.CalledProcessError, OSError):
+            return 0
+        if enabled.decode("utf-8").strip() != "true":
+            return 0
+        return self.utils.call_tool("git sparse-checkout disable",
+                                    cwd=repo_dir)
 
     def get_required_toolchains(self):
         return self.toolchains
 
-    def call_build_tool(self, command, target, nthreads):
+    def get_tool_env(self, toolchains_paths):
+        # the tool environment is computed only once
+        key = tuple(toolchains_paths)
+        if key not in self.tool_envs:
+            self.tool_envs[key] = self.utils.get_tool_env(toolchains_paths)
+        return self.tool_envs[key]
+
+    def call_build_tool(self, command, target, nthreads, env=None):
         call = command
         if nthreads != 0:
             call += " -j" + str(nthreads)
         try:
-            sp = self.utils.call_tool(call)
+            with self.utils.timing.span(command, target):
+                sp = self.utils.call_tool(call, cwd=self.master_repo_path +
+                                          "/" +
+                                          (self.targets[target])["repository"],
+                                          env=env,
+                                          templates=self.get_build_templates(
+                                              target))
             if sp != 0:
                 self.utils.print_message(self.utils.logtype.ERROR,
                                          "Error running", call,
@@ -952,9 +1345,11 @@ class Target:
                 (self.targets[target])["build"] = False
                 # set build error
                 (self.targets[target])["build_error"] = True
+                return False
             else:
                 self.utils.print_message(self.utils.logtype.OK, command,
                                          "completed successfully")
+                return True
         except Exception as exc:
             self.utils.print_message(self.utils.logtype.ERROR,
                                      "Error while running", call,
@@ -963,48 +1358,209 @@ class Target:
             (self.targets[target])["build"] = False
             # set build error
             (self.targets[target])["build_error"] = True
+            return False
+
+    def get_git_dir(self, repo_dir):
+        # resolved without calling git, submodules have a .git file
+        # pointing to their directory in the superproject
+        dot_git = repo_dir + "/.git"
+        if os.path.isdir(dot_git):
+            return dot_git
+        try:
+            with open(dot_git, "r") as f:
+                line = f.readline().strip()
+        except IOError:
+            return None
+        if not line.startswith("gitdir:"):
+            return None
+        return os.path.normpath(os.path.join(repo_dir,
+                                             line[len("gitdir:"):].strip()))
+
+    def get_head_commit(self, git_dir):
+        try:
+            with open(git_dir + "/HEAD", "r") as f:
+                head = f.readline().strip()
+            if not head.startswith("ref:"):
+                return head
+            ref = head[len("ref:"):].strip()
+            if os.path.isfile(git_dir + "/" + ref):
+                with open(git_dir + "/" + ref, "r") as f:
+                    return f.readline().strip()
+            with open(git_dir + "/packed-refs", "r") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        return fields[0]
+        except IOError:
+            pass
+        return None
+
+    def count_applied_patches(self, repo_dir, patch_paths):
+        """Return the number of patches at the start of the series which
+        are applied in repo_dir, checked by reverting them"""
+        for count in range(len(patch_paths), 0, -1):
+            # the last patch of the series is reverted first
+            call = ["git", "apply", "--reverse", "--check"] + \
+                list(reversed(patch_paths[:count]))
+            try:
+                subprocess.check_output(call, cwd=repo_dir,
+                                        stderr=subprocess.STDOUT)
+                return count
+            except (OSError, subprocess.CalledProcessError):
+                pass
+        return 0
+
+    def load_patch_index(self, index_path):
+        # base commit -> sha256 of the patches applied on top of it
+        try:
+            with open(index_path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def save_patch_index(self, index_path, base, applied):
+        # only the current base commit is kept, the working tree
+        # cannot be patched on top of any other one
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({base: applied}, f, indent=1)
+        os.rename(tmp_path, index_path)
+
+    def get_patch_paths(self, target):
+        return [self.config_path + "/" + p
+                for p in self.targets[target]["patches"] or []]
+
+    def revert_patches(self, target):
+        # restore the sources patched by apply_patch, e.g. before they
+        # are patched with the series of another device
+        target_folder = self.master_repo_path + "/"\
+            + (self.targets[target])["repository"]
+        patch_paths = self.get_patch_paths(target)
+        count = self.count_applied_patches(target_folder, patch_paths)
+        if count == 0:
+            return 0
+        # the last patch of the series is reverted first
+        call = "git apply --reverse " + \
+            " ".join(self.utils.shell_quote(p)
+                     for p in reversed(patch_paths[:count]))
+        if self.utils.call_tool(call, cwd=target_folder) != 0:
+            self.utils.print_message(self.utils.logtype.ERROR,
+                                     "Error while reverting the patches of",
+                                     str(target))
+            return 1
+        git_dir = self.get_git_dir(target_folder)
+        base = None
+        if git_dir is not None:
+            base = self.get_head_commit(git_dir)
+        if base is not None:
+            self.save_patch_index(git_dir + "/ebe_patches.json", base, [])
+        return 0
 
     def apply_patch(self, target):
         target_folder = self.master_repo_path + "/"\
             + (self.targets[target])["repository"]
-        for patch in self.targets[target]["patches"]:
-            patch_path = target_folder + "/" + patch
-            # if the patch file is already in the target folder
-            # we assume that the sources has been already patched
-            if os.path.isfile(patch_path):
-                continue
-            # copy the patch file
-            try:
-                shutil.copyfile(self.config_path + "/" + patch,
-                                patch_path)
-            except Exception as exc:
-                self.utils.print_message(self.utils.logtype.ERROR,
-                                         "Error while copying patch file",
-                                         patch, "for the target",
-                                         str(target), ":", str(exc))
-                return 1
-            # pach the code
-            try:
-                with self.utils.cd(target_folder):
-                    call = "git --apply " + patch
-                    sp = self.utils.call_tool(call)
-                    if sp != 0:
-                        self.utils.print_message(self.utils.logtype.ERROR,
-                                                 "Error while patching target",
-                                                 str(target), "with patch",
-                                                 patch)
-                        return 1
+        patches = self.targets[target]["patches"]
+        if not patches:
+            return 0
 
-            except Exception as exc:
+        patch_paths = self.get_patch_paths(target)
+        try:
+            patch_hashes = [self.utils.get_file_hash(p)
+                            for p in patch_paths]
+        except Exception as exc:
+            self.utils.print_message(self.utils.logtype.ERROR,
+                                     "Error while reading patch files",
+                                     "for the target", str(target), ":",
+                                     str(exc))
+            return 1
+
+        git_dir = self.get_git_dir(target_folder)
+        base = None
+        if git_dir is not None:
+            base = self.get_head_commit(git_dir)
+        if base is None:
+            self.utils.print_message(self.utils.logtype.ERROR,
+                                     "Could not find the checked out commit",
+                                     "of the target", str(target))
+            return 1
+        index_path = git_dir + "/ebe_patches.json"
+        applied = self.load_patch_index(index_path).get(base)
+
+        # the patch files were copied into the sources by older versions
+        if applied is None and \
+                all(os.path.isfile(target_folder + "/" + p) for p in patches):
+            applied = patch_hashes
+
+        changed = applied is not None and \
+            applied != patch_hashes[:len(applied)]
+        if applied is None or changed:
+            # HEAD moved, e.g. by fetching, and the patched files were
+            # carried along, or the series changed, find out how much
+            # of the series is in the sources
+            applied = patch_hashes[:self.count_applied_patches(
+                target_folder, patch_paths)]
+
+        if len(applied) == len(patches):
+            self.utils.print_message(self.utils.logtype.OK,
+                                     "Patches of", str(target),
+                                     "already applied")
+            if self.load_patch_index(index_path).get(base) != applied:
+                self.save_patch_index(index_path, base, applied)
+            return 0
+
+        # the series is applied at once, git apply changes nothing
+        # if any of the patches does not apply
+        call = "git apply " + " ".join(self.utils.shell_quote(p) for p in
+                                       patch_paths[len(applied):])
+        try:
+            sp = self.utils.call_tool(call, cwd=target_folder)
+            if sp != 0:
                 self.utils.print_message(self.utils.logtype.ERROR,
                                          "Error while patching target",
-                                         str(target), "with patch",
-                                         patch, ":", str(exc))
+                                         str(target), "with patches",
+                                         ", ".join(patches[len(applied):]))
+                if changed:
+                    self.utils.print_message(self.utils.logtype.ERROR,
+                                             "The sources of", str(target),
+                                             "were patched with a different",
+                                             "series of patches, restore",
+                                             "them before building")
                 return 1
+            self.save_patch_index(index_path, base, patch_hashes)
+        except Exception as exc:
+            self.utils.print_message(self.utils.logtype.ERROR,
+                                     "Error while patching target",
+                                     str(target), "with patches",
+                                     ", ".join(patches[len(applied):]), ":",
+                                     str(exc))
+            return 1
         # everything went OK
         return 0
 
-    def do_build(self, toolchains_paths, nthreads):
+    def get_build_dependencies(self, build_targets):
+        dependencies = dict()
+        for target in build_targets:
+            depends = self.targets[target]["depends"]
+            if depends is None:
+                # no explicit dependencies, wait for all the targets
+                # with a lower priority
+                dependencies[target] = \
+                    [t for t in build_targets if self.targets[t]["priority"] <
+                     self.targets[target]["priority"]]
+                continue
+            for d in depends:
+                if d not in self.targets:
+                    self.utils.print_message(self.utils.logtype.WARNING,
+                                             "Target", target, "depends on",
+                                             "undefined target", d)
+            # targets which are not built in this run are already there
+            dependencies[target] = [d for d in depends if d in build_targets]
+        return dependencies
+
+    def do_build(self, toolchains_paths, nthreads, build_jobs=0,
+                 force_rebuild=False):
+        nthreads = int(nthreads)
+        build_targets = []
         for target in sorted(self.targets,
                              key=lambda t: self.targets[t]["priority"]):
             if self.targets[target]["build"] is False:
@@ -1014,179 +1570,426 @@ class Target:
                 continue
             if self.targets[target]["disable_build"] is True:
                 continue
-            self.utils.print_message(self.utils.logtype.INFO, "Building",
-                                     target)
-            if self.targets[target]["patches"] is not None:
-                if self.apply_patch(target) != 0:
-                    # if patching failed, do not build this target
-                    self.targets[target]["build"] = False
-                    self.targets[target]["build_error"] = True
+            build_targets.append(target)
+
+        dependencies = self.get_build_dependencies(build_targets)
+
+        # find all the targets each target (indirectly) waits for
+        waits_for = dict()
+        for target in build_targets:
+            waits_for[target] = set()
+            todo = list(dependencies[target])
+            while todo:
+                d = todo.pop()
+                if d not in waits_for[target]:
+                    waits_for[target].add(d)
+                    todo.extend(dependencies[d])
+        # prefix the output only if two targets can be built at once
+        concurrent = build_jobs != 1 and \
+            any(a != b and a not in waits_for[b] and b not in waits_for[a]
+                for a in build_targets for b in build_targets)
+
+        env = self.get_tool_env(toolchains_paths)
+        finished = queue.Queue()
+
+        def build_job(target, jobs, inputs):
+            try:
+                if concurrent:
+                    self.utils.set_output_prefix("[" + target + "] ")
+                self.build_target(target, jobs, env, inputs, force_rebuild)
+                finished.put((target, None))
+            except BaseException as exc:
+                # e.g. break on error, re-raise it in the main thread
+                finished.put((target, exc))
+            finally:
+                self.utils.set_output_prefix(None)
+
+        pending = list(build_targets)
+        running = []
+        built = []
+        failed = []
+        while pending or running:
+            # do not build targets whose dependencies failed
+            for target in list(pending):
+                failed_deps = [d for d in dependencies[target]
+                               if d in failed]
+                if not failed_deps:
                     continue
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "Not building", target,
+                                         "because", ", ".join(failed_deps),
+                                         "failed to build")
+                (self.targets[target])["build"] = False
+                (self.targets[target])["build_error"] = True
+                pending.remove(target)
+                failed.append(target)
+
+            ready = [t for t in pending
+                     if all(d in built for d in dependencies[t])]
+            if build_jobs > 0:
+                ready = ready[:max(0, build_jobs - len(running))]
 
-            # init variables for device-tree
-            device_tree = []
-            dt_path = []
+            if not ready and not running:
+                if pending:
+                    self.utils.print_message(self.utils.logtype.ERROR,
+                                             "Circular dependency between",
+                                             "targets:",
+                                             ", ".join(pending))
+                    for target in pending:
+                        (self.targets[target])["build"] = False
+                        (self.targets[target])["build_error"] = True
+                break
+
+            # divide the jobs between the targets built at the same time
+            jobs = max(1, nthreads // (len(running) + len(ready)))
+            for target in ready:
+                pending.remove(target)
+                running.append(target)
+                # build inputs besides the sources of the target,
+                # None disables skipping of up to date subtargets
+                inputs = None
+                deps = sorted(dependencies[target])
+                if all(self.target_fingerprints.get(d) for d in deps):
+                    inputs = [str(p) for p in toolchains_paths]
+                    inputs += [self.target_fingerprints[d] for d in deps]
+                worker = threading.Thread(target=build_job,
+                                          args=(target, jobs, inputs))
+                worker.daemon = True
+                worker.start()
+
+            target, exc = self.utils.wait_interruptible(
+                lambda timeout: finished.get(True, timeout), queue.Empty)
+            if exc is not None:
+                raise exc
+            running.remove(target)
+            if (self.targets[target])["build_error"] is True:
+                failed.append(target)
+            else:
+                built.append(target)
+
+    def build_target(self, target, nthreads, env=None, inputs=None,
+                     force_rebuild=False):
+        self.utils.print_message(self.utils.logtype.INFO, "Building",
+                                 target)
+        if self.targets[target]["patches"] is not None:
+            with self.utils.timing.span("patch", target):
+                patched = self.apply_patch(target)
+            if patched != 0:
+                # if patching failed, do not build this target
+                self.targets[target]["build"] = False
+                self.targets[target]["build_error"] = True
+                return
 
-            # get device-tree list
-            if self.targets[target]["device-tree"] is not None:
-                for dt in (self.targets[target])["device-tree"]:
-                    device_tree.append(dt['cmd'])
+        # init variables for device-tree
+        device_tree = []
+        dt_path = []
 
-            # get device tree list from binary section
-            for binary in self.binaries:
-                if self.binaries[binary]["chosen"] is True:
-                    if self.binaries[binary][target + "-device-tree"] is not None:
-                        for dt in self.binaries[binary][target + "-device-tree"]:
-                            device_tree.append(dt['cmd'])
+        # get device-tree list
+        if self.targets[target]["device-tree"] is not None:
+            for dt in (self.targets[target])["device-tree"]:
+                device_tree.append(dt['cmd'])
 
-            # get device tree path
-            if self.targets[target]["device-tree-path"]:
-                dt_path = self.targets[target]["device-tree-path"][0]['path']
+        # get device tree list from binary section
+        for binary in self.binaries:
+            if self.binaries[binary]["chosen"] is True:
+                if self.binaries[binary][target + "-device-tree"] is not None:
+                    for dt in self.binaries[binary][target + "-device-tree"]:
+                        device_tree.append(dt['cmd'])
+
+        # get device tree path
+        if self.targets[target]["device-tree-path"]:
+            dt_path = self.targets[target]["device-tree-path"][0]['path']
+
+        # the generated files of an out-of-tree build belong to the device
+        tree_dir = self.get_tree_dir(target)
+        if self.get_build_dir(target) is not None:
+            try:
+                self.utils.mkdir_p(tree_dir + "/" + (dt_path or ""))
+            except Exception as exc:
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "Failed to create the build",
+                                         "directory of", target, ":",
+                                         str(exc))
+                (self.targets[target])["build"] = False
+                (self.targets[target])["build_error"] = True
+                return
+
+        # create device-tree only if files and path are specified for this target
+        if device_tree and dt_path:
+
+            # create dts file, it contains includes for all the required dtsi files
+            dtb = open(tree_dir + "/" + dt_path + "/enclustra_generated.dts",
+                       "w")
+            # write header to dts file,
+            dtb.write("/* AUTOGENERATED FILE - DO NOT MODIFY */\n")
+            dtb.write("/* This file is created by Enclustra Build Environment */\n\n")
+            dtb.write("/dts-v1/;\n\n")
+            # include the device tree for the module at the top (module device tree name starts with ME- or MA-)
+            for dt in device_tree:
+                if "MA-" in dt or "ME-" in dt or "AM-" in dt:
+                    dtb.write("#include \"" + dt + "\"\n")
+            # add other device tree below the module device tree
+            for dt in device_tree:
+                if "MA-" not in dt and "ME-" not in dt and "AM-" not in dt:
+                    dtb.write("#include \"" + dt + "\"\n")
+            dtb.close()
+            self.utils.print_message(self.utils.logtype.OK, target + " device-tree " + dt_path +
+                                     "/enclustra_generated.dts created successfully")
+        elif device_tree:
+            self.utils.print_message(self.utils.logtype.ERROR, target + "device-tree can not be added without path")
+
+        repo_dir = self.master_repo_path + "/" + \
+            (self.targets[target])["repository"]
+        # check if the repository is fetched
+        if not os.path.exists(repo_dir + "/.git"):
+            msg = "Attempting build of target: " + target
+            msg += ", but the repository is not fetched"
+            self.utils.print_message(self.utils.logtype.ERROR, msg)
+            (self.targets[target])["build"] = False
+            (self.targets[target])["build_error"] = True
+            return
+
+        if "prebuild" in self.targets[target]:
+            # copy script file to just fetched repository
+            try:
+                self.utils.run_script("prebuild",
+                                      self.targets[target],
+                                      self.config_path,
+                                      self.master_repo_path)
+            except:
+                (self.targets[target])["build"] = False
+                (self.targets[target])["build_error"] = True
 
-            # create device-tree only if files and path are specified for this target
+        # subtargets are skipped only if the outputs of the last build
+        # were copied and none of the inputs changed since then
+        fingerprint = None
+        if inputs is not None:
+            dts_file = None
             if device_tree and dt_path:
-		    
-                # create dts file, it contains includes for all the required dtsi files
-                dtb = open(self.master_repo_path + "/" + self.targets[target]["repository"] + "/" +
-			   dt_path + "/enclustra_generated.dts", "w")
-                # write header to dts file, 
-                dtb.write("/* AUTOGENERATED FILE - DO NOT MODIFY */\n")
-                dtb.write("/* This file is created by Enclustra Build Environment */\n\n")
-                dtb.write("/dts-v1/;\n\n")		
-                # include the device tree for the module at the top (module device tree name starts with ME- or MA-)
-                for dt in device_tree:
-                    if "MA-" in dt or "ME-" in dt or "AM-" in dt:
-                        dtb.write("#include \"" + dt + "\"\n")			
-                # add other device tree below the module device tree
-                for dt in device_tree:
-                    if "MA-" not in dt and "ME-" not in dt and "AM-" not in dt:
-                        dtb.write("#include \"" + dt + "\"\n")
-                dtb.close()
-                self.utils.print_message(self.utils.logtype.OK, target + " device-tree " + dt_path +
-					 "/enclustra_generated.dts created successfully")
-            elif device_tree:
-                self.utils.print_message(self.utils.logtype.ERROR, target + "device-tree can not be added without path")
-
-            with self.utils.cd((self.master_repo_path + "/" +
-                               (self.targets[target])["repository"])):
-                # check if the repository is fetched
-                if not os.path.exists(".git"):
-                    msg = "Attempting build of target: " + target
-                    msg += ", but the repository is not fetched"
-                    self.utils.print_message(self.utils.logtype.ERROR, msg)
-                    (self.targets[target])["build"] = False
-                    (self.targets[target])["build_error"] = True
+                dts_file = tree_dir + "/" + dt_path + \
+                    "/enclustra_generated.dts"
+            fingerprint = self.get_target_fingerprint(target, inputs,
+                                                      dts_file)
+        may_skip = fingerprint is not None and not force_rebuild and \
+            self.are_copyfiles_present(target)
+        fingerprints = self.load_fingerprints(target)
+
+        key = target + "-options"
+        if self.config.has_option(key, "build_order"):
+            # build targets according to defined order
+            count_subt_parallel = 0
+            count_subt_build = 0
+            for subt in self.config.get(key, "build_order").split(","):
+                sub_option = target + " " + subt
+                sub_found = False
+                for partar in (self.targets[target])[
+                               "parallelbuild_commands"]:
+                    if partar['name'] == sub_option:
+                        # build parallel targets
+                        if partar['enabled']:
+                            fingerprint = self.build_subtarget(
+                                partar, target, nthreads, env, fingerprint,
+                                fingerprints, may_skip)
+                        sub_found = True
+                        count_subt_parallel += 1
+                        break
+
+                # All targets from the build order section
+                # have to be defined either in the build
+                # or the parallel build section
+                if sub_found:
                     continue
+                for btar in (self.targets[target])["build_commands"]:
+                    if btar['name'] == sub_option:
+                        # build targets
+                        if btar['enabled']:
+                            fingerprint = self.build_subtarget(
+                                btar, target, 0, env, fingerprint,
+                                fingerprints, may_skip)
+                        sub_found = True
+                        count_subt_build += 1
+                        break
 
-                if "prebuild" in self.targets[target]:
-                    # copy script file to just fetched repository
-                    try:
-                        self.utils.run_script("prebuild",
-                                              self.targets[target],
-                                              self.config_path,
-                                              self.master_repo_path)
-                    except:
-                        (self.targets[target])["build"] = False
-                        (self.targets[target])["build_error"] = True
+                if sub_found:
+                    continue
+                self.utils.print_message(self.utils.logtype.ERROR,
+                                         "Undefined subtarget",
+                                         sub_option, "referenced "
+                                         "in the build order")
 
-                # store PATH
-                orig_path = os.environ["PATH"]
-                toolchain_path = ""
-                for path in toolchains_paths:
-                    toolchain_path += str(path) + ":"
-                os.environ["PATH"] = toolchain_path + orig_path
-
-                key = target + "-options"
-                if self.config.has_option(key, "build_order"):
-                    # build targets according to defined order
-                    count_subt_parallel = 0
-                    count_subt_build = 0
-                    for subt in self.config.get(key, "build_order").split(","):
-                        sub_option = target + " " + subt
-                        sub_found = False
-                        for partar in (self.targets[target])[
-                                       "parallelbuild_commands"]:
-                            if partar['name'] == sub_option:
-                                # build parallel targets
-                                if partar['enabled']:
-                                    self.call_build_tool(partar['cmd'],
-                                                     target, nthreads)
-                                sub_found = True
-                                count_subt_parallel += 1
-                                break
-
-                        # All targets from the build order section
-                        # have to be defined either in the build
-                        # or the parallel build section
-                        if sub_found:
-                            continue
-                        for btar in (self.targets[target])["build_commands"]:
-                            if btar['name'] == sub_option:
-                                # build targets
-                                if partar['enabled']:
-                                    self.call_build_tool(btar['cmd'], target, 0)
-                                sub_found = True
-                                count_subt_build += 1
-                                break
-
-                        if sub_found:
-                            continue
-                        self.utils.print_message(self.utils.logtype.ERROR,
-                                                 "Undefined subtarget",
-                                                 sub_option, "referenced "
-                                                 "in the build order")
-
-                    if count_subt_parallel < len((self.targets[target])[
-                                                  "parallelbuild_commands"]):
-                        self.utils.print_message(self.utils.logtype.WARNING,
-                                                 "Not all", target,
-                                                 "parallelbuild targets are "
-                                                 "included in the build "
-                                                 "order section")
-                    if count_subt_build < len((self.targets[target])[
-                                               "build_commands"]):
-                        self.utils.print_message(self.utils.logtype.WARNING,
-                                                 "Not all", target, "build "
-                                                 "targets are included in the "
-                                                 "build_order section")
-                else:
-                    # build parallel targets
-                    for subt in (self.targets[target])[
-                                 "parallelbuild_commands"]:
-                        if subt['enabled']:
-                            self.call_build_tool(subt['cmd'], target, nthreads)
-                    # build targets
-                    for subt in (self.targets[target])["build_commands"]:
-                        if subt['enabled']:
-                            self.call_build_tool(subt['cmd'], target, 0)
-
-                # restore original PATH
-                os.environ["PATH"] = orig_path
-                if "postbuild" in self.targets[target]:
-                    # copy script file to just fetched repository
-                    try:
-                        self.utils.run_script("postbuild",
-                                              self.targets[target],
-                                              self.config_path,
-                                              self.master_repo_path)
-                    except:
-                        (self.targets[target])["build"] = False
-                        (self.targets[target])["build_error"] = True
+            if count_subt_parallel < len((self.targets[target])[
+                                          "parallelbuild_commands"]):
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Not all", target,
+                                         "parallelbuild targets are "
+                                         "included in the build "
+                                         "order section")
+            if count_subt_build < len((self.targets[target])[
+                                       "build_commands"]):
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Not all", target, "build "
+                                         "targets are included in the "
+                                         "build_order section")
+        else:
+            # build parallel targets
+            for subt in (self.targets[target])[
+                         "parallelbuild_commands"]:
+                if subt['enabled']:
+                    fingerprint = self.build_subtarget(
+                        subt, target, nthreads, env, fingerprint,
+                        fingerprints, may_skip)
+            # build targets
+            for subt in (self.targets[target])["build_commands"]:
+                if subt['enabled']:
+                    fingerprint = self.build_subtarget(
+                        subt, target, 0, env, fingerprint, fingerprints,
+                        may_skip)
 
-    def do_custom_cmd(self, toolchains, custom_dir, custom_cmd):
-        # store PATH
-        orig_path = os.environ["PATH"]
-        toolchain_path = ""
-        for path in toolchains:
-            toolchain_path += str(path) + ":"
-        os.environ["PATH"] = toolchain_path + orig_path
+        if "postbuild" in self.targets[target]:
+            # copy script file to just fetched repository
+            try:
+                self.utils.run_script("postbuild",
+                                      self.targets[target],
+                                      self.config_path,
+                                      self.master_repo_path)
+            except:
+                (self.targets[target])["build"] = False
+                (self.targets[target])["build_error"] = True
+
+        if (self.targets[target])["build_error"] is False:
+            # the targets depending on this one are rebuilt
+            # if it was rebuilt with different inputs
+            self.target_fingerprints[target] = fingerprint
+
+    def get_target_fingerprint(self, target, inputs, dts_file):
+        # hash of the sources of the target and everything else
+        # the build depends on, except the build commands
+        repo_dir = self.master_repo_path + "/" + \
+            (self.targets[target])["repository"]
+        sha = hashlib.sha256()
+        try:
+            # the committed sources and the local changes to them,
+            # this includes the applied patches
+            for call in (["git", "rev-parse", "HEAD^{tree}"],
+                         ["git", "diff", "HEAD", "--binary"]):
+                sha.update(subprocess.check_output(call, cwd=repo_dir))
+            for patch in (self.targets[target])["patches"] or []:
+                with open(self.config_path + "/" + patch, "rb") as f:
+                    sha.update(f.read())
+            if dts_file is not None:
+                with open(dts_file, "rb") as f:
+                    sha.update(f.read())
+            # the configuration is not tracked by git, e.g. after
+            # menuconfig, and is kept in the build directory
+            # of out-of-tree builds
+            config_file = self.get_tree_dir(target) + "/.config"
+            if os.path.isfile(config_file):
+                with open(config_file, "rb") as f:
+                    sha.update(b"\0config\0" + f.read())
+        except Exception as exc:
+            self.utils.print_message(self.utils.logtype.WARNING,
+                                     "Could not check if", target,
+                                     "is up to date:", str(exc))
+            return None
+
+        chosen = sorted(b for b in self.binaries
+                        if self.binaries[b]["chosen"] is True)
+        for value in inputs + chosen:
+            sha.update(b"\0" + value.encode("utf-8"))
+        return sha.hexdigest()
+
+    def are_copyfiles_present(self, target):
+        if self.out_dir is None:
+            return False
+        for outfile in (self.targets[target])["copy_files"]:
+            if not os.path.isfile(self.out_dir + "/" + outfile[0]):
+                return False
+        return True
 
-        with self.utils.cd(custom_dir):
-            sp = self.utils.call_tool(custom_cmd)
+    def get_fingerprints_path(self, target):
+        # the fingerprints are kept with the build tree, which is shared
+        # by all the devices using the repository unless the target
+        # is built out of tree
+        build_dir = self.get_build_dir(target)
+        if build_dir is not None:
+            return build_dir + "/ebe_fingerprints.json"
+        repo_dir = self.master_repo_path + "/" + \
+            str((self.targets[target])["repository"])
+        try:
+            git_dir = subprocess.check_output(["git", "rev-parse",
+                                               "--git-dir"], cwd=repo_dir)
+        except Exception:
+            return None
+        return os.path.join(repo_dir, git_dir.decode("utf-8").strip(),
+                            "ebe_fingerprints.json")
+
+    def get_build_lock_paths(self):
+        # lock files of the build trees of the targets to build,
+        # kept next to the fingerprints
+        paths = []
+        for target in self.targets:
+            if not (self.targets[target])["build"]:
+                continue
+            fingerprints_path = self.get_fingerprints_path(target)
+            if fingerprints_path is not None:
+                paths.append(os.path.join(os.path.dirname(fingerprints_path),
+                                          "ebe_build.lock"))
+        return paths
+
+    def load_fingerprints(self, target):
+        fingerprints = {"path": self.get_fingerprints_path(target)}
+        try:
+            with open(fingerprints["path"], "r") as f:
+                fingerprints["subtargets"] = json.load(f)
+        except (TypeError, IOError, ValueError):
+            fingerprints["subtargets"] = dict()
+        return fingerprints
+
+    def save_fingerprint(self, fingerprints, subtarget, fingerprint):
+        if fingerprints["path"] is None:
+            return
+        with self.fingerprint_lock:
+            if fingerprint is None:
+                fingerprints["subtargets"].pop(subtarget, None)
+            else:
+                fingerprints["subtargets"][subtarget] = fingerprint
+            try:
+                tmp_path = fingerprints["path"] + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(fingerprints["subtargets"], f, indent=1,
+                              sort_keys=True)
+                os.rename(tmp_path, fingerprints["path"])
+            except Exception as exc:
+                self.utils.print_message(self.utils.logtype.WARNING,
+                                         "Error while saving build",
+                                         "fingerprints:", str(exc))
+
+    def build_subtarget(self, subtarget, target, nthreads, env, fingerprint,
+                        fingerprints, may_skip):
+        # the fingerprint of a subtarget covers the ones built before it,
+        # so everything after a rebuilt subtarget is rebuilt as well
+        if fingerprint is not None:
+            fingerprint = hashlib.sha256((fingerprint + "\0" +
+                                          subtarget['cmd']).encode("utf-8")
+                                         ).hexdigest()
+        if may_skip and \
+                fingerprints["subtargets"].get(subtarget['name']) == fingerprint:
+            self.utils.print_message(self.utils.logtype.OK,
+                                     subtarget['cmd'], "is up to date,",
+                                     "skipping")
+            return fingerprint
+
+        # forget the previous build before the build tree is modified
+        self.save_fingerprint(fingerprints, subtarget['name'], None)
+        if self.call_build_tool(subtarget['cmd'], target, nthreads, env) and \
+                fingerprint is not None:
+            self.save_fingerprint(fingerprints, subtarget['name'],
+                                  fingerprint)
+        return fingerprint
 
-        # restore original PATH
-        os.environ["PATH"] = orig_path
-        return sp
+    def do_custom_cmd(self, toolchains, custom_dir, custom_cmd):
+        return self.utils.call_tool(custom_cmd, cwd=custom_dir,
+                                    env=self.get_tool_env(toolchains))
 
     def fetch_only_run(self):
         for target in self.targets:
@@ -1194,14 +1997,28 @@ class Target:
                 return False
         return True
 
-    def do_get_binaries(self, dst_path):
+    def is_binary_needed(self, binary):
+        if (self.binaries[binary])["chosen"] is False:
+            return False
+        # all binary files are custom - we can skip
+        return not self.is_copyfiles_all_custom(binary)
+
+    def prefetch_binaries(self, download_cache):
+        # start downloading the binaries needed by do_get_binaries
         if self.fetch_only_run():
             return
         for binary in self.binaries:
-            if (self.binaries[binary])["chosen"] is False:
-                continue
-            if (self.is_copyfiles_all_custom(binary)):
-                # all binary files are custom - we can skip
+            if self.is_binary_needed(binary):
+                download_cache.prefetch(
+                    self.binaries[binary]["uri"],
+                    force=self.binaries[binary]["redownload"],
+                    sha256=self.binaries[binary]["sha256"])
+
+    def do_get_binaries(self, dst_path, download_cache):
+        if self.fetch_only_run():
+            return
+        for binary in self.binaries:
+            if not self.is_binary_needed(binary):
                 continue
             self.utils.print_message(self.utils.logtype.INFO, "Getting binary",
                                      binary)
@@ -1216,33 +2033,31 @@ class Target:
                 continue
             # download binary
             binary_file = os.path.basename(self.binaries[binary]["uri"])
-            call = "curl -L -O "
-            if self.binaries[binary]["redownload"] is False:
-                call = call + "-z " + download_path + "/" + binary_file
-            elif os.path.isfile(download_path + "/" + binary_file):
-                os.remove(download_path + "/" + binary_file)
-            call = call + " " + self.binaries[binary]["uri"]
-            temp_path = tempfile.mkdtemp()
-
-            with self.utils.cd(temp_path):
-                sp = self.utils.call_tool(call)
-                if sp == 0:
-                    # see if it is downloaded
-                    if os.path.exists(temp_path + "/" + binary_file):
-                        self.utils.print_message(Utils.logtype.INFO,
-                                                 "New version of",
-                                                 binary_file,
-                                                 "downloaded.")
-                        # everything ok, copy to real destination
-                        shutil.copy(temp_path + "/" + binary_file,
-                                        download_path + "/")
-                    else:
-                        self.utils.print_message(Utils.logtype.INFO,
-                                                 "No new version of",
-                                                 binary_file,
-                                                 "available")
-
-            shutil.rmtree(temp_path)
+            binary_path = download_path + "/" + binary_file
+            try:
+                cached_path, updated = download_cache.fetch(
+                    self.binaries[binary]["uri"],
+                    force=self.binaries[binary]["redownload"],
+                    sha256=self.binaries[binary]["sha256"])
+                if updated or not os.path.isfile(binary_path):
+                    self.utils.print_message(Utils.logtype.INFO,
+                                             "New version of",
+                                             binary_file,
+                                             "downloaded.")
+                else:
+                    self.utils.print_message(Utils.logtype.INFO,
+                                             "No new version of",
+                                             binary_file,
+                                             "available")
+                download_cache.place(cached_path, binary_path)
+                sp = 0
+            except cache.ChecksumError as exc:
+                # an older version cannot be trusted either
+                self.utils.print_message(self.utils.logtype.ERROR, str(exc))
+                continue
+            except Exception as exc:
+                self.utils.print_message(self.utils.logtype.INFO, str(exc))
+                sp = 1
 
             if sp != 0:
                 # We could not download file, check if an older version exist
@@ -1265,58 +2080,56 @@ class Target:
                     continue
             # unpack binary (if required)
             if self.binaries[binary]["unpack"] is True:
-                with self.utils.cd(download_path):
-                    try:
-                        a = archive.Archive(os.path.basename(
-                                            self.binaries[binary]["uri"]))
-                        a.extract()
-                    except Exception as exc:
-                        # the downloaded file is corrupted, delete it
-                        shutil.rmtree(download_path)
+                try:
+                    with self.utils.timing.span("extract " + binary_file):
+                        a = archive.Archive(download_path + "/" + binary_file)
+                        a.extract(download_path)
+                except Exception as exc:
+                    # the downloaded file is corrupted, delete it and
+                    # leave the other files of the binary alone
+                    download_cache.invalidate(self.binaries[binary]["uri"])
+                    if os.path.isfile(binary_path):
+                        os.remove(binary_path)
 
-                        self.utils.print_message(self.utils.logtype.ERROR,
-                                                 "Error while unpacking",
-                                                 binary, "binary:", exc,
-                                                 "- deleting.")
-                        continue
+                    self.utils.print_message(self.utils.logtype.ERROR,
+                                             "Error while unpacking",
+                                             binary, "binary:", exc,
+                                             "- deleting.")
+                    continue
             # if everything went OK add path to binary descriptor
-            self.binaries[binary].update([("path", download_path)])
+            self.binaries[binary]["path"] = download_path
 
-    def do_copyfiles(self):
+    def do_copyfiles(self, copy_jobs=1):
+        # the messages and the copies are collected first, the copies run
+        # in parallel and everything is printed in the original order
+        items = []
         for target in self.targets:
             # do not copy files for targets that weren't built
             if (self.targets[target])["build"] is True:
-                self.utils.print_message(self.utils.logtype.INFO,
-                                         "Copying files for", target)
+                items.append(("message", self.utils.logtype.INFO,
+                              "Copying files for " + target))
+                repo_dir = self.master_repo_path + "/" + \
+                    (self.targets[target])["repository"]
+                tree_dir = self.get_tree_dir(target)
                 for outfile in (self.targets[target])["copy_files"]:
-                    src = self.master_repo_path + "/" +\
-                        (self.targets[target])["repository"] +\
-                        "/" + outfile[1]
+                    src = tree_dir + "/" + outfile[1]
+                    # files which are not built, e.g. scripts,
+                    # stay in the sources
+                    if not os.path.exists(src):
+                        src = repo_dir + "/" + outfile[1]
                     dst = self.out_dir + "/" + outfile[0]
                     dstdir = "/".join(dst.split("/")[:-1])
 
                     dstdir = os.path.abspath(dstdir)
 
                     if dstdir.startswith(self.out_dir) is False:
-                        self.utils.print_message(self.utils.logtype.ERROR,
-                                                 "Destination file out of",
-                                                 "output directory")
+                        items.append(("message", self.utils.logtype.ERROR,
+                                      "Destination file out of output "
+                                      "directory"))
                         continue
 
                     self.utils.mkdir_p(dstdir)
-
-                    try:
-                        shutil.copyfile(src, dst)
-                        shutil.copymode(src, dst)
-                        self.utils.print_message(self.utils.logtype.INFO,
-                                                 "Copying ./" +
-                                                 os.path.relpath(src) +
-                                                 " to ./" +
-                                                 os.path.relpath(dst))
-                    except Exception as exc:
-                        self.utils.print_message(self.utils.logtype.ERROR,
-                                                 "Error while copying file",
-                                                 src, ":", str(exc))
+                    items.append(("copy", src, dst, self.utils.logtype.ERROR))
 
             # delete any existing previous products of failed builds
             if (self.targets[target])["build_error"] is True:
@@ -1332,8 +2145,8 @@ class Target:
 
         # there are some binaries
         if bool(self.binaries) and not self.fetch_only_run():
-            self.utils.print_message(self.utils.logtype.INFO,
-                                     "Copying binaries")
+            items.append(("message", self.utils.logtype.INFO,
+                          "Copying binaries"))
         # copy binaries
         for binary in self.binaries:
             # copy files only for chosen binary set
@@ -1341,7 +2154,7 @@ class Target:
                 continue
             # path is set only when download was successfull
             # so skip copying if it's unset
-            if ('path' not in self.binaries[binary].keys() and
+            if ('path' not in self.binaries[binary] and
                     not self.is_copyfiles_all_custom(binary)):
                 continue
             if (self.binaries[binary])["copy_files"] is not None:
@@ -1351,20 +2164,37 @@ class Target:
                     else:
                         src = self.binaries[binary]["path"] + "/" + outfile[1]
                     dst = self.out_dir + "/" + outfile[0]
-                    try:
-                        shutil.copyfile(src, dst)
-                        self.utils.print_message(self.utils.logtype.INFO,
-                                                 "Copying ./" +
-                                                 os.path.relpath(src) +
-                                                 " to ./" +
-                                                 os.path.relpath(dst))
-                    except Exception as exc:
-                        self.utils.print_message(self.utils.logtype.WARNING,
-                                                 "Error while copying file",
-                                                 src, ":", str(exc))
+                    items.append(("copy", src, dst,
+                                  self.utils.logtype.WARNING))
             else:
-                self.utils.print_message(self.utils.logtype.WARNING,
-                                         "No binary files to copy found")
+                items.append(("message", self.utils.logtype.WARNING,
+                              "No binary files to copy found"))
+
+        def copy_job(item):
+            if item[0] != "copy":
+                return item, None, None
+            try:
+                with self.utils.timing.span("copy " + item[2].split("/")[-1]):
+                    method = self.utils.copy_file(item[1], item[2])
+                # the paths are shown relative, computed by the worker
+                if method == "unchanged":
+                    return item, "./" + os.path.relpath(item[2]) + \
+                        " is up to date", None
+                return item, "Copying ./" + os.path.relpath(item[1]) + \
+                    " to ./" + os.path.relpath(item[2]) + \
+                    " (" + method + ")", None
+            except Exception as exc:
+                return item, None, exc
+
+        for item, text, exc in self.utils.run_parallel(copy_job, items,
+                                                       copy_jobs):
+            if item[0] == "message":
+                self.utils.print_message(item[1], item[2])
+            elif exc is not None:
+                self.utils.print_message(item[3], "Error while copying file",
+                                         item[1], ":", str(exc))
+            else:
+                self.utils.print_message(self.utils.logtype.INFO, text)
 
     def do_generate_image(self, directory, toolchains_paths):
         bootimages = self.get_bootimages()
@@ -1377,10 +2207,9 @@ class Target:
 
             # check if every required file is accessible
             missing_files = []
-            with self.utils.cd(directory):
-                for f in bootimages[k]['files']:
-                    if not os.path.isfile(f):
-                        missing_files.append(f)
+            for f in bootimages[k]['files']:
+                if not os.path.isfile(os.path.join(directory, f)):
+                    missing_files.append(f)
 
             if len(missing_files):
                 generate_img = False
@@ -1396,9 +2225,10 @@ class Target:
             if generate_img:
                 self.utils.print_message(self.utils.logtype.INFO,
                                          "Generating boot image")
-                sp = self.do_custom_cmd(toolchains_paths,
-                                        directory,
-                                        bootimages[k]['cmd'])
+                with self.utils.timing.span("bootimage " + k):
+                    sp = self.do_custom_cmd(toolchains_paths,
+                                            directory,
+                                            bootimages[k]['cmd'])
                 if sp != 0:
                     self.utils.print_message(self.utils.logtype.ERROR,
                                              "Error generating bootimage:",
@@ -1410,19 +2240,18 @@ class Target:
 
             # if the image was not generated we need to delete previously
             # generated files
-            with self.utils.cd(directory):
-                if 'result_files' not in bootimages[k].keys():
+            if 'result_files' not in bootimages[k].keys():
+                continue
+            for f in bootimages[k]['result_files']:
+                if not os.path.isfile(os.path.join(directory, f)):
                     continue
-                for f in bootimages[k]['result_files']:
-                    if not os.path.isfile(f):
-                        continue
 
-                    try:
-                        os.remove(f)
-                    except Exception as exc:
-                        self.utils.print_message(self.utils.logtype.WARNING,
-                                                 "Failed to remove file",
-                                                 f, ":", str(exc))
+                try:
+                    os.remove(os.path.join(directory, f))
+                except Exception as exc:
+                    self.utils.print_message(self.utils.logtype.WARNING,
+                                             "Failed to remove file",
+                                             f, ":", str(exc))
 
     def get_summary(self, oneline=False):
         # decide which separator to use
@@ -1452,10 +2281,16 @@ class Target:
 
             current_target_line += " ("
             # check if target is to be fetched
-            if self.targets[t]["fetch"]:
+            if t in self.up_to_date_targets:
+                current_target_line += "up to date"
+            elif self.targets[t]["fetch"]:
                 current_target_line += "fetch"
                 if self.targets[t]["history"]:
                     current_target_line += " \w history"
+                if self.get_fetch_filter(t) is not None:
+                    current_target_line += " \w partial clone"
+                if self.get_sparse_dirs(t):
+                    current_target_line += " \w sparse checkout"
 
             # add plus sign if target is to be both fetched and built
             if self.targets[t]["build"] and self.targets[t]["fetch"]:
@@ -1494,3 +2329,52 @@ class Target:
             summary.append(binary_lines)
 
         return (line_sep+"\n").join(summary)
+
+
+def init_describe_worker():
+    # nothing but the records may reach the output,
+    # e.g. Target calls "clear" on errors
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def describe_device(job):
+    # describe the targets and binaries of a device,
+    # used as a worker of a process pool
+    root_path, master_repo_path, device, release, parse_cache = job
+    record = {"device": device}
+    utils = Utils()
+    utils.set_colors(False)
+    # the messages are reported in the record
+    utils.start_output_capture()
+    try:
+        ini_files = utils.get_ini_files(root_path, device)
+        t = Target(root_path, master_repo_path,
+                   root_path + "/targets/" + device, ini_files,
+                   device.replace("/", "_").replace(" ", "_"), False, utils,
+                   None, release, False, parse_cache=parse_cache)
+        targets = []
+        for tgt in t.get_build():
+            subtargets = []
+            for subt in (t.targets[tgt[0]]["parallelbuild_commands"] +
+                         t.targets[tgt[0]]["build_commands"]):
+                subtargets.append({"name": subt["name"].split(" ", 1)[1],
+                                   "default": subt["enabled"]})
+            targets.append({"name": tgt[0], "default": tgt[2],
+                            "subtargets": subtargets})
+        record["targets"] = targets
+        record["binaries"] = [{"name": b["name"],
+                               "description": b["description"],
+                               "default": b["default"]}
+                              for b in t.get_marked_binaries()]
+    except SystemExit as exc:
+        # Target exits on errors in the ini files, after reporting them
+        record["error"] = "Parsing failed with exit status " + str(exc)
+    except Exception as exc:
+        record["error"] = str(exc)
+    messages = [log for console, log in utils.stop_output_capture()
+                if log is not None]
+    if messages:
+        record["messages"] = "".join(messages).splitlines()
+    return record
@@ -0,0 +1,213 @@
+#! /usr/bin/env python2
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# \file timing.py
+# \brief Enclustra Build Environment timing class
+#
+# \copyright Copyright (c) 2015-2017 Enclustra GmbH, Switzerland. All rights reserved.
+# \licence This code is released under the Modified BSD licence.
+
+import json
+import time
+import resource
+import threading
+
+
+class Timing:
+    """
+    Records how long the steps of a run take and which resources
+    they use. Every step is a span, written as a JSON line to the
+    trace file when it ends.
+
+    The child counters come from getrusage(RUSAGE_CHILDREN), so they
+    include all the children which finished during the span, also
+    the ones of spans running at the same time in other threads.
+
+    getrusage only reports the peak resident set size of the whole
+    run, so a span records how much this peak grew while it was open:
+    steps which needed no more memory than an earlier one record 0.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.start_time = time.time()
+        self.last_id = 0
+        # spans currently open, per thread
+        self.stacks = dict()
+        self.main_thread = threading.current_thread().ident
+
+    def set_trace_file(self, trace_file):
+        self.trace_file = trace_file
+
+    def span(self, name, target=None):
+        return Span(self, name, target)
+
+    def open_span(self, span):
+        with self.lock:
+            self.last_id += 1
+            stack = self.stacks.setdefault(threading.current_thread().ident,
+                                           [])
+            # the spans of worker threads belong to the span
+            # open in the main thread
+            if not stack:
+                stack = self.stacks.get(self.main_thread, [])
+            parent = stack[-1] if stack else None
+            self.stacks[threading.current_thread().ident].append(span)
+            if parent is not None:
+                parent.children += 1
+            return self.last_id, parent
+
+    def close_span(self, span):
+        with self.lock:
+            self.stacks[threading.current_thread().ident].remove(span)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(span, sort_keys=True) + "\n")
+                self.trace_file.flush()
+
+    def get_slowest(self, count=10):
+        with self.lock:
+            spans = list(self.spans)
+        # the enclosing spans would always be the slowest ones
+        spans = [s for s in spans if not s["children"]]
+        return sorted(spans, key=lambda s: s["wall"], reverse=True)[:count]
+
+    def get_summary(self, count=10):
+        lines = []
+        slowest = self.get_slowest(count)
+        if not slowest:
+            return lines
+        lines.append("Slowest steps:")
+        lines.append("{:>9} {:>9} {:>9}  {}".format("wall [s]", "cpu [s]",
+                                                    "+rss [MB]", "step"))
+        for span in slowest:
+            name = span["name"]
+            if span["target"] is not None:
+                name = "[" + span["target"] + "] " + name
+            lines.append("{:>9.1f} {:>9.1f} {:>9.1f}  {}".format(
+                span["wall"], span["child_cpu"] + span["cpu"],
+                span["rss_growth"] / 1024.0, name))
+        return lines
+
+    def write_chrome_trace(self, path):
+        """Write the spans in the Chrome trace event format, it can be
+        opened in chrome://tracing or Perfetto"""
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: (s["start"], -s["wall"]))
+
+        # every target gets a track, the other spans of the main thread
+        # share one and the ones of the worker threads (copies, downloads)
+        # are spread over as many tracks as there were at the same time
+        tracks = ["run"]
+        lanes = []
+        events = []
+        for span in spans:
+            if span["target"] is not None:
+                track = span["target"]
+            elif span["thread"] == "MainThread":
+                track = "run"
+            else:
+                end = span["start"] + span["wall"]
+                for lane, lane_end in enumerate(lanes):
+                    if lane_end <= span["start"]:
+                        break
+                else:
+                    lane = len(lanes)
+                    lanes.append(0)
+                lanes[lane] = end
+                track = "jobs " + str(lane + 1)
+            if track not in tracks:
+                tracks.append(track)
+
+            args = dict((k, span[k]) for k in ("cpu", "child_cpu",
+                                               "rss_growth", "written",
+                                               "failed"))
+            events.append({"name": span["name"],
+                           "cat": span["target"] or "run",
+                           "ph": "X",
+                           "ts": int(span["start"] * 1e6),
+                           "dur": int(span["wall"] * 1e6),
+                           "pid": 1,
+                           "tid": tracks.index(track) + 1,
+                           "args": args})
+
+        for tid, track in enumerate(tracks):
+            events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                           "tid": tid + 1, "args": {"name": track}})
+            events.append({"name": "thread_sort_index", "ph": "M", "pid": 1,
+                           "tid": tid + 1, "args": {"sort_index": tid}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1,
+                       "args": {"name": "build"}})
+
+        with open(path, "w") as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                      trace)
+
+    @staticmethod
+    def get_written_bytes():
+        # bytes written by this process, linux only
+        try:
+            with open("/proc/self/io", "r") as io:
+                for line in io:
+                    if line.startswith("write_bytes:"):
+                        return int(line.split()[1])
+        except (IOError, ValueError):
+            pass
+        return 0
+
+
+class Span:
+    """Context manager measuring a single step"""
+
+    def __init__(self, timing, name, target):
+        self.timing = timing
+        self.name = name
+        self.target = target
+        self.children = 0
+
+    def __enter__(self):
+        self.id, self.parent = self.timing.open_span(self)
+        self.start = time.time()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.written = Timing.get_written_bytes()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        end = time.time()
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.timing.close_span(self)
+
+        span = dict()
+        span["id"] = self.id
+        span["parent"] = self.parent.id if self.parent is not None else None
+        span["name"] = self.name
+        span["target"] = self.target
+        span["thread"] = threading.current_thread().name
+        span["start"] = self.start - self.timing.start_time
+        span["wall"] = end - self.start
+        span["cpu"] = (self_usage.ru_utime + self_usage.ru_stime -
+                       self.self_usage.ru_utime - self.self_usage.ru_stime)
+        span["child_cpu"] = (child_usage.ru_utime + child_usage.ru_stime -
+                             self.child_usage.ru_utime -
+                             self.child_usage.ru_stime)
+        # growth of the peak resident set size in KiB, of this process
+        # or the biggest child, whichever is larger, see Timing
+        span["rss_growth"] = \
+            max(self_usage.ru_maxrss, child_usage.ru_maxrss) - \
+            max(self.self_usage.ru_maxrss, self.child_usage.ru_maxrss)
+        # the children report 512 byte blocks
+        span["written"] = (Timing.get_written_bytes() - self.written +
+                           (child_usage.ru_oublock -
+                            self.child_usage.ru_oublock) * 512)
+        span["children"] = self.children
+        span["failed"] = etype is not None
+        self.timing.record(span)
+        return False
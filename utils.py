@@ -14,12 +14,38 @@
 import subprocess
 import os
 import shutil
+import stat
 import errno
+import json
+import hashlib
 import archive
+import cache
+import timing
 import re
 import shlex
 import sys
 import signal
+import select
+import time
+import fcntl
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+# ioctl request cloning a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# the output of the tools is read in chunks and written out in batches
+OUTPUT_CHUNK_SIZE = 64 * 1024
+OUTPUT_BATCH_SIZE = 1024 * 1024
+OUTPUT_FLUSH_INTERVAL = 0.2
+
+# waits of the main thread time out this often, see wait_interruptible
+WAIT_INTERVAL = 0.2
 
 
 class Utils:
@@ -50,6 +76,14 @@ class Utils:
         self.warning_count = 0
         self.error_count = 0
         self.tool_templates = {}
+        # guards the console, the log file and the message counters
+        self.output_lock = threading.RLock()
+        # per-thread state, used to buffer output of parallel jobs
+        self.thread_state = threading.local()
+        # duration and resource usage of the steps of the run
+        self.timing = timing.Timing()
+        # ccache wrapping the compilers of the toolchains, if enabled
+        self.compiler_cache = None
 
     def remove_folder(self, folder):
         try:
@@ -72,6 +106,9 @@ class Utils:
     def set_log_file(self, log_file):
         self.log_file = log_file
 
+    def set_compiler_cache(self, compiler_cache):
+        self.compiler_cache = compiler_cache
+
     def set_quiet_mode(self, mode):
         self.quiet_mode = mode
 
@@ -91,49 +128,135 @@ class Utils:
         elif loglevel == self.logtype.WARNING:
             textcolor = ((self.bcolors.BOLD + self.bcolors.WARNING) if
                          self.nicecolors else "") + "WARNING: "
-            self.warning_count += 1
         elif loglevel == self.logtype.ERROR:
             textcolor = ((self.bcolors.BOLD + self.bcolors.ERROR) if
                          self.nicecolors else "") + "ERROR: "
-            self.error_count += 1
         elif loglevel == self.logtype.HEADER:
             textcolor = ((self.bcolors.HEADER) if
                          self.nicecolors else "") + "+"
         else:
             textcolor = ""
 
-        if self.log_file is not None:
-            self.log_file.write(" ".join(str(i) for i in args) + '\n')
-            self.log_file.flush()
+        with self.output_lock:
+            if loglevel == self.logtype.WARNING:
+                self.warning_count += 1
+            elif loglevel == self.logtype.ERROR:
+                self.error_count += 1
 
-        print(textcolor + " ".join(str(i) for i in args) +
-              (self.bcolors.ENDC if self.nicecolors else ""))
+        text = " ".join(str(i) for i in args)
+        self.write_output(textcolor + text +
+                          (self.bcolors.ENDC if self.nicecolors else "") +
+                          "\n", text + "\n")
 
         if loglevel == self.logtype.ERROR:
             if self.break_on_error is True:
-                print('\n')
-                print("Break on error is set. Terminating run!")
+                self.write_output("\n\n", None)
+                self.write_output("Break on error is set. Terminating run!\n",
+                                  None)
                 sys.exit(1)
 
+    def write_output(self, console_text, log_text):
+        # output of threads running in capture mode is kept aside
+        # and written out later as a single block
+        prefix = getattr(self.thread_state, "prefix", None)
+        if prefix:
+            if console_text is not None:
+                console_text = "".join(prefix + line for line in
+                                       console_text.splitlines(True))
+            if log_text is not None:
+                log_text = "".join(prefix + line for line in
+                                   log_text.splitlines(True))
+
+        captured = getattr(self.thread_state, "captured", None)
+        if captured is not None:
+            captured.append((console_text, log_text))
+        else:
+            self.flush_captured_output([(console_text, log_text)])
+
+    def set_output_prefix(self, prefix):
+        # prefix every output line of the calling thread
+        self.thread_state.prefix = prefix
+
+    def start_output_capture(self):
+        self.thread_state.captured = []
+
+    def stop_output_capture(self):
+        captured = getattr(self.thread_state, "captured", None)
+        self.thread_state.captured = None
+        return captured if captured is not None else []
+
+    def flush_captured_output(self, captured):
+        with self.output_lock:
+            for console_text, log_text in captured:
+                if log_text is not None and self.log_file is not None:
+                    self.log_file.write(log_text)
+                    self.log_file.flush()
+                if console_text is not None:
+                    sys.stdout.write(console_text)
+
+    def run_parallel(self, function, items, jobs):
+        """Run function for every item using up to jobs threads.
+        The results are yielded in the order of items."""
+        items = list(items)
+        if jobs <= 1 or len(items) <= 1:
+            for item in items:
+                yield function(item)
+            return
+
+        pool = ThreadPool(min(jobs, len(items)))
+        try:
+            results = pool.imap(function, items)
+            while True:
+                try:
+                    result = self.wait_interruptible(
+                        results.next, multiprocessing.TimeoutError)
+                except StopIteration:
+                    break
+                yield result
+        finally:
+            pool.close()
+
+    @staticmethod
+    def wait_interruptible(wait, *timeout_errors):
+        """Return wait(timeout), calling it again as long as it raises
+        one of timeout_errors. Without a timeout, python2 does not
+        deliver SIGINT to the main thread while it waits."""
+        while True:
+            try:
+                return wait(WAIT_INTERVAL)
+            except timeout_errors:
+                continue
+
+    def shell_quote(self, value):
+        # quote a path or an url for the calls of call_tool
+        return shell_quote(str(value))
+
     def add_tool_template(self, field, value):
         self.tool_templates[field] = value
 
-    def call_tool(self, call):
-        # fill tool templates
-        call = call.format(**self.tool_templates)
+    def get_tool_env(self, paths):
+        # environment for calling tools with the given paths
+        # prepended to the PATH variable
+        env = dict(os.environ)
+        env["PATH"] = os.pathsep.join([str(p) for p in paths] +
+                                      [env.get("PATH", "")])
+        return env
+
+    def call_tool(self, call, cwd=None, env=None, templates=None):
+        # fill tool templates, the given ones apply only to this call
+        if templates:
+            call = call.format(**dict(self.tool_templates, **templates))
+        else:
+            call = call.format(**self.tool_templates)
 
         returncode = 1
         if self.debug is True:
             self.print_message(self.logtype.HEADER, call)
         try:
             proc = subprocess.Popen(call, stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT, shell=True)
-            for line in iter(proc.stdout.readline, ""):
-                if self.quiet_mode is False:
-                    sys.stdout.write(line)
-                if self.log_file is not None:
-                    self.log_file.write(line)
-                    self.log_file.flush()
+                                    stderr=subprocess.STDOUT, shell=True,
+                                    cwd=cwd, env=env)
+            self.forward_output(proc.stdout)
             proc.wait()
             returncode = proc.returncode
         except Exception as ext:
@@ -143,13 +266,58 @@ class Utils:
 
         return returncode
 
+    def forward_output(self, pipe):
+        # read the output in chunks and write out the complete lines
+        # in batches, at the latest OUTPUT_FLUSH_INTERVAL after they
+        # were read
+        fd = pipe.fileno()
+        pending = b""
+        lines = []
+        size = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            ready = select.select([fd], [], [], timeout)[0]
+            if ready:
+                data = os.read(fd, OUTPUT_CHUNK_SIZE)
+                if not data:
+                    break
+                pending += data
+                end = pending.rfind(b"\n") + 1
+                if end:
+                    lines.append(pending[:end])
+                    size += end
+                    pending = pending[end:]
+                    if deadline is None:
+                        deadline = time.time() + OUTPUT_FLUSH_INTERVAL
+            if lines and (not ready or size >= OUTPUT_BATCH_SIZE or
+                          time.time() >= deadline):
+                self.write_tool_output(b"".join(lines))
+                lines = []
+                size = 0
+                deadline = None
+        # the last line may not be terminated
+        if pending:
+            lines.append(pending)
+        if lines:
+            self.write_tool_output(b"".join(lines))
+        pipe.close()
+
+    def write_tool_output(self, text):
+        if not isinstance(text, str):
+            # lines never end inside a multibyte character
+            text = text.decode("utf-8", "replace")
+        self.write_output(None if self.quiet_mode else text, text)
+
     def get_git_revision(self, root_path):
         call = "git rev-parse --short HEAD"
-        with self.cd(root_path):
-            try:
-                revision = subprocess.check_output(shlex.split(call))
-            except:
-                revision = "unknown"
+        try:
+            revision = subprocess.check_output(shlex.split(call),
+                                               cwd=root_path)
+        except:
+            revision = "unknown"
         return revision
 
     def run_script(self, state, target, boardpath, master_repo_path):
@@ -167,16 +335,15 @@ class Utils:
             self.print_message(self.logtype.ERROR, "Error copying file", src,
                                "to", dst)
             raise IOError
-        with self.cd(dst):
-            try:
-                call = "bash "+new_cmd
-                sp = self.call_tool(call)
-            except:
-                sp = -1
-            if sp != 0:
-                self.print_message(self.logtype.ERROR, state.capitalize(),
-                                   "script", script, "failed")
-                raise IOError
+        try:
+            call = "bash "+new_cmd
+            sp = self.call_tool(call, cwd=dst)
+        except:
+            sp = -1
+        if sp != 0:
+            self.print_message(self.logtype.ERROR, state.capitalize(),
+                               "script", script, "failed")
+            raise IOError
 
     def register_toolchain(self, toolchains, name, config, remote):
         descriptor = dict()
@@ -185,6 +352,8 @@ class Utils:
             try:
                 descriptor.update([("server", config[name]["server"])])
                 descriptor.update([("path", config[name]["path"])])
+                # optional checksum of the toolchain archive
+                descriptor.update([("sha256", config[name].get("sha256"))])
             except:
                 # catch all the exceptions print warning and return
                 self.print_message(self.logtype.WARNING,
@@ -193,7 +362,41 @@ class Utils:
                 return
         toolchains.update([(name, descriptor)])
 
-    def acquire_toolchains(self, required, registered, path, debug_calls):
+    def prefetch_toolchains(self, required, registered, path,
+                            download_cache):
+        # start downloading the toolchains which will be unpacked
+        # by acquire_toolchains
+        for toolchain in required:
+            if toolchain not in registered or \
+                    registered[toolchain]["remote"] is False:
+                continue
+            marker_path = path + "/bin/." + toolchain + ".complete"
+            if self.is_toolchain_complete(marker_path,
+                                          registered[toolchain]["server"],
+                                          registered[toolchain].get("sha256")):
+                continue
+            # tar archives are unpacked while they are being downloaded
+            unpack = self.get_toolchain_unpacker(
+                os.path.basename(registered[toolchain]["server"]),
+                path + "/bin")
+            download_cache.prefetch(registered[toolchain]["server"],
+                                    revalidate=False,
+                                    sha256=registered[toolchain].get("sha256"),
+                                    consumer=unpack)
+
+    def get_toolchain_unpacker(self, toolchain_file, bin_path):
+        # zip files need seeking, they are extracted from the cached copy
+        # by acquire_toolchains once they are downloaded
+        if not archive.is_tar(toolchain_file):
+            return None
+
+        def unpack(fileobj):
+            with self.timing.span("extract " + toolchain_file):
+                archive.extract_stream(fileobj, bin_path, toolchain_file)
+        return unpack
+
+    def acquire_toolchains(self, required, registered, path, debug_calls,
+                           download_cache):
         return_paths = []
         for toolchain in required:
             if toolchain in registered:
@@ -202,44 +405,53 @@ class Utils:
                     continue
 
                 toolchain_location = registered[toolchain]["server"]
-
-                with self.cd(path + "/bin"):
-                    # if archive exists but the catalog does not it is probably
-                    # a malformed archive - delete it
-                    if os.path.isfile(os.path.basename(toolchain_location)):
-                        if not os.path.isdir(registered[toolchain]["path"]):
-                            self.print_message(self.logtype.INFO,
-                                               "Toolchain archive seems to",
-                                               "be corrupted, redownloading")
-                            os.remove(os.path.basename(toolchain_location))
-
-                    if os.path.isfile(
-                            os.path.basename(toolchain_location)) is False:
-                        call = "curl -L -O " + toolchain_location
-                        if self.call_tool(call) != 0:
-                            self.print_message(self.logtype.ERROR,
-                                               "Error while downloading",
-                                               "toolchain")
-                            raise NameError("Required toolchains: " +
-                                            ", ".join(required))
-                        try:
-                            a = archive.Archive(
-                                os.path.basename(toolchain_location))
-                            a.extract()
-                        except Exception as ext:
-                            # the downloaded file is corrupted, delete it
-                            os.remove(os.path.basename(toolchain_location))
-
-                            self.print_message(self.logtype.ERROR,
-                                               "Error while unpacking",
-                                               os.path.basename(
-                                                   toolchain_location),
-                                               "toolchain.",
-                                               str(ext),
-                                               "- deleting.")
-
-                            raise NameError("Required toolchains: " +
-                                            ", ".join(required))
+                toolchain_file = os.path.basename(toolchain_location)
+                bin_path = path + "/bin"
+                # the marker is written only after the toolchain was
+                # downloaded and unpacked successfully
+                marker_path = bin_path + "/." + toolchain + ".complete"
+
+                sha256 = registered[toolchain].get("sha256")
+                if not self.is_toolchain_complete(marker_path,
+                                                  toolchain_location,
+                                                  sha256):
+                    try:
+                        # toolchain archives are versioned,
+                        # the cached ones do not need to be revalidated,
+                        # a prefetch has unpacked it already
+                        cached_path, updated = download_cache.fetch(
+                            toolchain_location, revalidate=False,
+                            consumer=self.get_toolchain_unpacker(
+                                toolchain_file, bin_path),
+                            sha256=sha256)
+                        if not archive.is_tar(toolchain_file):
+                            with self.timing.span("extract " +
+                                                  toolchain_file):
+                                archive.extract(cached_path, bin_path,
+                                                filename=toolchain_file)
+                    except cache.DownloadError as ext:
+                        self.print_message(self.logtype.ERROR,
+                                           "Error while downloading",
+                                           "toolchain:", str(ext))
+                        raise NameError("Required toolchains: " +
+                                        ", ".join(required))
+                    except Exception as ext:
+                        # the downloaded file is corrupted, delete it
+                        download_cache.invalidate(toolchain_location)
+
+                        self.print_message(self.logtype.ERROR,
+                                           "Error while unpacking",
+                                           toolchain_file,
+                                           "toolchain.",
+                                           str(ext),
+                                           "- deleting.")
+
+                        raise NameError("Required toolchains: " +
+                                        ", ".join(required))
+
+                    with open(marker_path, "w") as marker:
+                        marker.write(toolchain_location + "\n")
+                        marker.write(os.path.basename(cached_path) + "\n")
 
                 return_paths.append(path + "/bin/" +
                                     registered[toolchain]["path"])
@@ -247,8 +459,33 @@ class Utils:
                 self.print_message(self.logtype.ERROR, required,
                                    "toolchain is not registered")
                 raise NameError("Required toolchains: " + ", ".join(required))
+
+        # the ccache wrappers of the compilers come first on the PATH
+        if self.compiler_cache is not None:
+            try:
+                masquerade_path = self.compiler_cache.get_masquerade_path(
+                    return_paths)
+            except (IOError, OSError) as ext:
+                self.print_message(self.logtype.WARNING,
+                                   "Could not set up the compiler cache:",
+                                   str(ext))
+                masquerade_path = None
+            if masquerade_path is not None:
+                return_paths.insert(0, masquerade_path)
         return return_paths
 
+    def is_toolchain_complete(self, marker_path, toolchain_location,
+                              sha256=None):
+        # the second line is the checksum of the unpacked archive
+        try:
+            with open(marker_path, "r") as marker:
+                if marker.readline().strip() != toolchain_location:
+                    return False
+                return sha256 is None or \
+                    marker.readline().strip() == sha256.strip().lower()
+        except IOError:
+            return False
+
     def tryint(self, x):
         try:
             return int(x)
@@ -259,41 +496,221 @@ class Utils:
         return tuple(self.tryint(x) for x in re.split('([0-9]+)', s))
 
     def check_tool(self, command, option, version_location, minimal_version):
-        try:
-            stdoutdata = subprocess.check_output([command, option],
-                                                 stderr=subprocess.PIPE)
-        except:
+        versions = self.probe_tools([[command, option, version_location]])
+        return self.is_version_at_least(versions[command], minimal_version)
+
+    def is_version_at_least(self, version, minimal_version):
+        if version is None:
             return False
-        local = \
-            self.splittedname(str(stdoutdata).split()[version_location - 1])
-        minimal = self.splittedname(minimal_version)
-        return local >= minimal
+        return self.splittedname(version) >= \
+            self.splittedname(minimal_version)
+
+    def find_executable(self, command):
+        # resolve the command like the shell does, links included
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            candidate = os.path.join(path, command)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return os.path.realpath(candidate)
+        return None
+
+    def probe_tools(self, tools, cache_path=None):
+        """Return the versions of the tools given as [command, option,
+        version_location, ...] lists, None for the missing ones.
+        The versions are cached in cache_path, only the tools which
+        changed since the last run are called."""
+        cached = dict()
+        if cache_path is not None:
+            try:
+                with open(cache_path, "r") as f:
+                    cached = json.load(f)
+            except (IOError, ValueError):
+                pass
 
-    def list_devices_raw(self, root_path, entry_point=""):
+        versions = dict()
+        probes = dict()
+        for tool in tools:
+            command, option, version_location = tool[:3]
+            key = " ".join([command, option, str(version_location)])
+            path = self.find_executable(command)
+            if path is None:
+                versions[command] = None
+                continue
+            st = os.stat(path)
+            entry = {"path": path, "mtime": st.st_mtime, "inode": st.st_ino}
+            old = cached.get(key)
+            if old is not None and old.get("version") is not None and \
+                    all(old.get(k) == v for k, v in entry.items()):
+                versions[command] = old["version"]
+                continue
+            # every tool is probed once, e.g. git is required twice
+            probes[key] = (command, path, option, version_location, entry)
+
+        def probe(key):
+            command, path, option, version_location, entry = probes[key]
+            try:
+                stdoutdata = subprocess.check_output([path, option],
+                                                     stderr=subprocess.PIPE)
+                version = stdoutdata.decode("utf-8", "replace").split()[
+                    version_location - 1]
+            except Exception:
+                version = None
+            return key, version
+
+        for key, version in self.run_parallel(probe, sorted(probes),
+                                              len(probes)):
+            versions[probes[key][0]] = version
+            cached[key] = dict(probes[key][4], version=version)
+
+        if probes and cache_path is not None:
+            try:
+                self.mkdir_p(os.path.dirname(cache_path))
+                tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(cached, f, indent=1, sort_keys=True)
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError):
+                pass
+        return versions
+
+    def get_devices(self, root_path, entry_point=""):
+        devices = []
         for root, dirs, fls in os.walk(root_path + "/targets/" + entry_point):
             if root == "targets" + entry_point:
                 continue
             if len(dirs) == 0:
                 # remove the leading targets catalog
-                root = root.replace(root_path + "/targets/", '')
-                # make the spaces copy-pasteable
-                print(root)
+                devices.append(root.replace(root_path + "/targets/", ''))
+        return devices
+
+    def get_ini_files(self, root_path, device):
+        # build.ini files of the device, from the most generic one
+        parse_dir = root_path + "/targets"
+        ini_files = list()
+        if os.path.isfile(parse_dir + "/build.ini"):
+            ini_files.append(parse_dir + "/build.ini")
+        for directory in (str(device)).split("/"):
+            parse_dir += "/" + directory
+            if not os.path.exists(parse_dir):
+                raise ValueError("device argument not supported: " +
+                                 str(directory))
+            if os.path.isfile(parse_dir + "/build.ini"):
+                ini_files.append(parse_dir + "/build.ini")
+        return ini_files
+
+    def list_devices_raw(self, root_path, entry_point=""):
+        for device in self.get_devices(root_path, entry_point):
+            # make the spaces copy-pasteable
+            print(device)
 
     def list_devices(self, root_path, entry_point=""):
         print(str("List of available devices:"))
         self.list_devices_raw(root_path, entry_point)
 
-    class cd:
-        """Context manager for changing the current working directory"""
-        def __init__(self, newPath):
-            self.newPath = os.path.expanduser(newPath)
+    def reflink(self, src, dst):
+        # share the data blocks of src with dst (btrfs, xfs, ...)
+        with open(src, "rb") as src_file:
+            with open(dst, "wb") as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+    def link_or_copy(self, src, dst):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            self.reflink(src, dst)
+            shutil.copymode(src, dst)
+            return
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+        shutil.copy2(src, dst)
+
+    def copy_file_range(self, src, dst):
+        # copy inside the kernel, without passing the data through
+        # user space (python 3.8 or newer)
+        with open(src, "rb") as src_file:
+            with open(dst, "wb") as dst_file:
+                size = os.fstat(src_file.fileno()).st_size
+                while size > 0:
+                    copied = os.copy_file_range(src_file.fileno(),
+                                                dst_file.fileno(), size)
+                    if copied == 0:
+                        break
+                    size -= copied
+
+    def get_file_hash(self, path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def is_file_unchanged(self, src, dst, src_stat):
+        try:
+            dst_stat = os.stat(dst)
+        except OSError:
+            return False
+        if os.path.samestat(src_stat, dst_stat):
+            return True
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        # the full precision of the time, a file rebuilt within
+        # the same second may have the same size
+        if self.get_mtime(src_stat) == self.get_mtime(dst_stat):
+            return True
+        # same size but a different time, e.g. rebuilt with
+        # the same result, compare the contents
+        if self.get_file_hash(src) != self.get_file_hash(dst):
+            return False
+        self.copy_times(src_stat, dst)
+        return True
+
+    def get_mtime(self, st):
+        # nanoseconds where available (python 3)
+        return getattr(st, "st_mtime_ns", st.st_mtime)
 
-        def __enter__(self):
-            self.savedPath = os.getcwd()
-            os.chdir(self.newPath)
+    def copy_times(self, src_stat, dst):
+        if hasattr(src_stat, "st_mtime_ns"):
+            os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        else:
+            os.utime(dst, (src_stat.st_atime, src_stat.st_mtime))
+
+    def copy_file(self, src, dst):
+        """Copy src to dst in the cheapest possible way and return how
+        it was done: "unchanged", "linked", "reflinked" or "copied"."""
+        src_stat = os.stat(src)
+        if self.is_file_unchanged(src, dst, src_stat):
+            return "unchanged"
+
+        # never write into the old file, it may be a hard link
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        # read only files (e.g. from the download cache) are not
+        # modified in place, so they can be shared
+        if not src_stat.st_mode & (stat.S_IWUSR | stat.S_IWGRP |
+                                   stat.S_IWOTH):
+            try:
+                os.link(src, dst)
+                return "linked"
+            except OSError:
+                pass
 
-        def __exit__(self, etype, value, traceback):
-            os.chdir(self.savedPath)
+        method = "reflinked"
+        try:
+            self.reflink(src, dst)
+        except (IOError, OSError):
+            method = "copied"
+            try:
+                self.copy_file_range(src, dst)
+            except (AttributeError, IOError, OSError):
+                shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+        # keep the time, the next copy is skipped if nothing changed
+        self.copy_times(src_stat, dst)
+        return method
 
     def mkdir_p(self, path):
         try: